@@ -0,0 +1,67 @@
+"""
+    Load/save benchmarks for the document container,
+    comparing the JSON and binary track encodings
+    and serial against parallel compression of members.
+"""
+from entities import *
+from generate_document import generate
+import os, sys, time, random, tempfile
+
+# Patch blobs that compress about as well as sampled audio does.
+def synthetic_instruments(document, count, size, seed=0):
+    rng = random.Random(seed)
+    low_bits = bytes(i & 0x3f for i in range(256))
+    for _ in range(count):
+        uid = document.next_uid()
+        blob = rng.randbytes(size).translate(low_bits)
+        path = f'patch.{uid}'
+        document.instruments.append(Instrument('urn:synthetic',
+            {'sample': {'type': 'http://lv2plug.in/ns/ext/atom#Chunk', 'path': path}},
+            {path: blob}, uid))
+
+def bench_save(document, workers, compression=None, repeat=3):
+    fd, filename = tempfile.mkstemp(suffix='.mide.zip')
+    os.close(fd)
+    try:
+        save = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            save_document(filename, document, 'binary', compression=compression, workers=workers)
+            save = min(save, time.perf_counter() - t0)
+        return save, os.path.getsize(filename)
+    finally:
+        os.remove(filename)
+
+def bench(document, track_format, repeat=3):
+    fd, filename = tempfile.mkstemp(suffix='.mide.zip')
+    os.close(fd)
+    try:
+        save = load = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            save_document(filename, document, track_format)
+            t1 = time.perf_counter()
+            loaded = load_document(filename)
+            t2 = time.perf_counter()
+            save = min(save, t1 - t0)
+            load = min(load, t2 - t1)
+        size = os.path.getsize(filename)
+        for a, b in zip(document.track.graphs, loaded.track.graphs):
+            assert a.as_json() == b.as_json(), "round trip mismatch"
+        return save, load, size
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    staves = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    notes_per_staff = int(sys.argv[2]) if len(sys.argv) > 2 else 25000
+    document = generate(staves, notes_per_staff)
+    print(f"{staves} staves, {staves * notes_per_staff} notes")
+    for track_format in ['json', 'binary']:
+        save, load, size = bench(document, track_format)
+        print(f"  {track_format:6} save {save:7.3f}s  load {load:7.3f}s  size {size / 1e6:7.2f} MB")
+    synthetic_instruments(document, 8, 1 << 21)
+    print(f"8 compressed patches, {os.cpu_count()} cores")
+    for workers in sorted({1, os.cpu_count() or 1}):
+        save, size = bench_save(document, workers, {'patch': 6})
+        print(f"  {workers:2} workers save {save:7.3f}s  size {size / 1e6:7.2f} MB")
@@ -0,0 +1,146 @@
+"""
+    Speed and quality benchmarks for voice separation.
+    Note sets are made of independent lines, so the line each note came from
+    is the ground truth. A MIDI file can be used instead, its staves
+    (tracks, or channels of a format 0 file) are taken as the true voices.
+
+    Reports the time of the C search and of the Python reference,
+    the cost breakdown of each result next to the cost of the ground truth,
+    and the share of notes put in the right voice under the best relabeling.
+    A search that swaps two voices halfway scores low on the latter,
+    even if every slice on its own is right.
+    With --hot, the slices where the C search took the most steps are listed.
+"""
+from generate_document import generate_voice, Fractions, Pitches, SequentialUids
+from entities import Staff, UidGenerator
+import resolution
+import numpy as np
+import argparse
+import itertools
+import random
+import time
+
+SETTINGS = resolution.VoiceSeparationSettings(
+    max_voices = 6,
+    pitch_penalty = 1,
+    gap_penalty = 1,
+    chord_penalty = 1,
+    overlap_penalty = 1,
+    cross_penalty = 1,
+    pitch_lookback = 2)
+
+# Each line walks within 7 steps of its register, registers 15 steps apart
+# keep the ranges of the lines apart, so they never cross.
+# The truth still gets a cross cost in slices where a line has several chords:
+# the cost divides the first chord's positions by the notes of all of them.
+# Returns the notes and the line of each one.
+def voice_lines(count, lines, seed=0, tuplet_density=0.1):
+    rng = random.Random(seed)
+    fraction = Fractions()
+    pitch = Pitches()
+    next_uid = SequentialUids(1)
+    notes = []
+    truth = []
+    for line in range(lines):
+        size = count // lines + (line < count % lines)
+        voice, ticks = generate_voice(rng, size, 7 + 15 * line, tuplet_density, fraction, pitch, next_uid, 0)
+        notes.extend(voice)
+        truth.extend([line] * len(voice))
+    return as_notes(notes, truth)
+
+def midi_lines(filename):
+    import midi
+    notes = []
+    truth = []
+    staves = [graph for graph in midi.import_smf(filename, UidGenerator(1)) if isinstance(graph, Staff)]
+    for line, staff in enumerate(staves[:SETTINGS.max_voices]):
+        notes.extend(staff.notes)
+        truth.extend([line] * len(staff.notes))
+    return as_notes(notes, truth)
+
+# Sorted by onset the way voice_separation sorts them, truth follows along.
+def as_notes(notes, truth):
+    pairs = sorted(zip((resolution.Note(note.uid, float(note.position), float(note.duration), note.pitch.position)
+                        for note in notes), truth), key=lambda pair: pair[0].onset)
+    return [note for note, line in pairs], np.array([line for note, line in pairs], dtype=np.int32)
+
+def voice_array(notes, voices):
+    voice_of = {}
+    for i, voice in enumerate(voices):
+        for note in voice:
+            voice_of[note.uid] = i
+    return np.array([voice_of[note.uid] for note in notes], dtype=np.int32)
+
+# Voices are unlabeled, the score is taken under the relabeling that matches best.
+def accuracy(truth, voice, max_voices):
+    confusion = np.zeros((max_voices, max_voices), dtype=np.int64)
+    np.add.at(confusion, (truth, voice), 1)
+    rows = np.arange(max_voices)
+    best = max(confusion[rows, list(order)].sum() for order in itertools.permutations(range(max_voices)))
+    return best / max(1, len(truth))
+
+def separation(notes, settings, stats=False):
+    return resolution.Separation(
+        np.array([note.onset for note in notes], dtype=np.float64),
+        np.array([note.duration for note in notes], dtype=np.float64),
+        np.array([note.pitch for note in notes], dtype=np.int32),
+        settings, stats)
+
+def cost(notes, voice, settings):
+    result = separation(notes, settings)
+    result.voice[:] = voice
+    return result.cost()
+
+def hot_slices(notes, settings, count):
+    stats = separation(notes, settings, stats=True).solve().stats()
+    print(f"  {len(stats)} slices, {stats.iterations.sum()} steps, {stats.improvements.sum()} improvements")
+    for row in stats[np.argsort(-stats.iterations, kind='stable')[:count]]:
+        breakdown = "  ".join(f"{part} {row[part]:6.2f}" for part in resolution.COST_PARTS)
+        print(f"    at {notes[row.start].onset:9.2f} {row.notes:4} notes {row.iterations:7} steps"
+              f" {row.improvements:4} improvements  cost {row.cost:7.2f}  {breakdown}")
+
+def run(name, separate, notes, truth, settings, repeat):
+    elapsed = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        voices = separate(list(notes), settings)
+        elapsed = min(elapsed, time.perf_counter() - t0)
+    voice = voice_array(notes, voices)
+    report(name, elapsed, cost(notes, voice, settings), accuracy(truth, voice, settings.max_voices))
+
+def report(name, elapsed, cost, correct=None):
+    total, parts = cost
+    timing = f"{elapsed:8.3f}s" if elapsed is not None else " " * 9
+    score = f"{correct * 100:6.1f}%" if correct is not None else " " * 7
+    breakdown = "  ".join(f"{part} {value:8.2f}" for part, value in parts.items())
+    print(f"  {name:10} {timing} {score}  cost {total:9.2f}  {breakdown}")
+
+def bench(notes, truth, settings, reference_limit, repeat, hot=0):
+    print(f"{len(notes)} notes in {len(set(truth.tolist()))} lines")
+    report("truth", None, cost(notes, truth, settings))
+    run("C", lambda notes, settings: resolution.voice_separation(notes, settings, cache=None), notes, truth, settings, repeat)
+    if hot:
+        hot_slices(notes, settings, hot)
+    if len(notes) <= reference_limit:
+        random.seed(0)
+        run("reference", resolution.voice_separation_reference, notes, truth, settings, 1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[200, 1000, 10000, 100000])
+    parser.add_argument('--lines', type=int, default=4, help="independent lines in generated note sets")
+    parser.add_argument('--midi', help="take notes and true voices from a MIDI file instead")
+    parser.add_argument('--restarts', type=int, default=1, help="searches per slice, wall time grows with them past the core count")
+    parser.add_argument('--reference-limit', type=int, default=200, help="largest note set given to the Python reference")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hot', type=int, default=0, help="list this many slices where the search took the most steps")
+    args = parser.parse_args()
+    settings = SETTINGS._replace(restarts=args.restarts)
+    if args.midi:
+        notes, truth = midi_lines(args.midi)
+        bench(notes, truth, settings, args.reference_limit, args.repeat, args.hot)
+    else:
+        for size in args.sizes:
+            notes, truth = voice_lines(size, args.lines, args.seed)
+            bench(notes, truth, settings, args.reference_limit, args.repeat, args.hot)
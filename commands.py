@@ -1,7 +1,12 @@
 """
     Commands record actions made for document.
 """
+from array import array
+from collections import deque
+import entities
+import resolution
 import gui
+import sys
 
 class DemoCommand:
     def __init__(self):
@@ -10,17 +15,216 @@ class DemoCommand:
         print('done')
     def undo(self, document):
         print('undone')
+    def size(self):
+        return sys.getsizeof(self)
 
+def find_graph(document, uid):
+    for graph in document.track.graphs:
+        if graph.uid == uid:
+            return graph
+    raise KeyError(uid)
+
+# Changes to the notes of one staff. Only the changed notes are recorded,
+# the changed fields as columns of before/after values next to their uids,
+# so doing and undoing touches nothing else in the staff.
+# Notes that are no longer in the staff are skipped.
+# Removed notes go back where they were when removed_at gives their ascending indices.
+# Deltas with the same coalesce key done in a row become one history entry,
+# the first one keeps its before values and takes the after values of the next.
+class NoteDelta:
+    def __init__(self, name, staff_uid, uids, changes, added=(), removed=(), coalesce=None, removed_at=None):
+        self.name = name
+        self.staff_uid = staff_uid
+        self.uids = array('q', uids)
+        self.changes = changes # field -> (before values, after values)
+        self.added = list(added)
+        self.removed = list(removed)
+        self.removed_at = removed_at
+        self.coalesce = coalesce
+        self.nbytes = self.measure()
+
+    def do(self, document):
+        notes = find_graph(document, self.staff_uid).notes
+        if self.removed_at is not None and all(
+                i < len(notes) and notes[i] is note for i, note in zip(self.removed_at, self.removed)):
+            notes.delete_at(self.removed_at)
+        elif self.removed:
+            notes.discard(self.removed)
+        notes.extend(self.added)
+        set_fields(notes, self.uids, self.changes, 1)
+
+    def undo(self, document):
+        notes = find_graph(document, self.staff_uid).notes
+        set_fields(notes, self.uids, self.changes, 0)
+        if self.added:
+            notes.discard(self.added)
+        if self.removed_at is not None:
+            notes.insert_at(self.removed_at, self.removed)
+        else:
+            notes.extend(self.removed)
+
+    def merge(self, other):
+        if (self.coalesce is None or other.coalesce != self.coalesce
+            or other.staff_uid != self.staff_uid
+            or other.added or other.removed or self.added or self.removed
+            or other.changes.keys() != self.changes.keys()
+            or other.uids != self.uids):
+            return False
+        for field, (before, after) in other.changes.items():
+            self.changes[field] = (self.changes[field][0], after)
+        return True
+
+    # Approximate bytes held by the delta, values shared with the document count too.
+    def measure(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.uids)
+        for before, after in self.changes.values():
+            size += sys.getsizeof(before) + sum(map(sys.getsizeof, before))
+            size += sys.getsizeof(after) + sum(map(sys.getsizeof, after))
+        size += NOTE_SIZE * (len(self.added) + len(self.removed))
+        return size
+
+    def size(self):
+        return self.nbytes
+
+NOTE_SIZE = 400 # Note2 with its Fractions, roughly
+
+# side is 0 for the before values and 1 for the after values.
+def set_fields(notes, uids, changes, side):
+    for i, uid in enumerate(uids):
+        try:
+            note = notes.by_uid(uid)
+        except KeyError:
+            continue
+        for field, values in changes.items():
+            setattr(note, field, values[side][i])
+
+# Records the change of fields of the given notes to new values,
+# changes maps field names to sequences of values, one for each note.
+def note_delta(name, staff, notes, changes, coalesce=None):
+    return NoteDelta(name, staff.uid, [note.uid for note in notes],
+        dict((field, ([getattr(note, field) for note in notes], list(values)))
+             for field, values in changes.items()),
+        coalesce=coalesce)
+
+# Bulk edits on a selection of notes. Each one is a single pass over the
+# selected notes that returns one delta for History.do. Pitches are computed
+# once per distinct pitch, selections rarely have many.
+def selected_notes(staff, uids):
+    return [note for note in staff.notes if note.uid in uids]
+
+# Positions are shifted from origin when given, so a drag can restart from where it began.
+def shift_notes(staff, notes, offset, origin=None, coalesce=None):
+    if origin is None:
+        origin = [note.position for note in notes]
+    return note_delta("move notes", staff, notes,
+        {'position': [max(0, position + offset) for position in origin]},
+        coalesce=coalesce)
+
+def transpose_notes(staff, notes, steps):
+    pitches = {}
+    def transposed(pitch):
+        if pitch not in pitches:
+            pitches[pitch] = entities.Pitch(pitch.position + steps, pitch.accidental)
+        return pitches[pitch]
+    return note_delta("transpose", staff, notes,
+        {'pitch': [transposed(note.pitch) for note in notes]})
+
+# Picks the closest simple spelling of the transposed pitch in the key at each note.
+def chromatic_transpose_notes(staff, notes, semitones):
+    smeared = entities.smear(staff.blocks)
+    pitches = {}
+    def transposed(note):
+        canonical_key = entities.by_beat(smeared, note.position).canonical_key
+        pitch = note.pitch
+        if (pitch, canonical_key) not in pitches:
+            key = resolution.canon_key(canonical_key)
+            m = resolution.resolve_pitch(pitch, key) + semitones
+            cost = lambda p: abs(pitch.position - p.position) + resolution.pitch_complexity(p)
+            pitches[pitch, canonical_key] = min(resolution.enharmonics(m, key), key=cost)
+        return pitches[pitch, canonical_key]
+    return note_delta("chromatic transpose", staff, notes,
+        {'pitch': [transposed(note) for note in notes]})
+
+# Scales durations, and positions around pivot.
+def scale_notes(staff, notes, factor, pivot):
+    return note_delta("scale notes", staff, notes, {
+        'position': [(note.position - pivot) * factor + pivot for note in notes],
+        'duration': [note.duration * factor for note in notes],
+    })
+
+def set_timbre(staff, notes, timbre):
+    return note_delta("set instrument", staff, notes, {'timbre': [timbre] * len(notes)})
+
+def set_accidental(staff, notes, accidental):
+    return note_delta("set accidental", staff, notes,
+        {'pitch': [entities.Pitch(note.pitch.position, accidental) for note in notes]})
+
+# Mirrors the pitches around their mean, then moves them back to the same mean.
+def invert_notes(staff, notes):
+    pivot = round(resolution.mean(note.pitch.position for note in notes))
+    positions = [2 * pivot - note.pitch.position for note in notes]
+    shift = pivot - round(resolution.mean(positions))
+    return note_delta("invert", staff, notes,
+        {'pitch': [entities.Pitch(position + shift, note.pitch.accidental)
+                   for position, note in zip(positions, notes)]})
+
+def retrograde_notes(staff, notes, beat0, beat1):
+    return note_delta("retrograde", staff, notes,
+        {'position': [beat1 - (note.position - beat0) - note.duration for note in notes]})
+
+def chord_notes(staff, notes, beat0, beat1):
+    return note_delta("chord", staff, notes, {
+        'position': [beat0] * len(notes),
+        'duration': [beat1 - beat0] * len(notes),
+    })
+
+# Each note is cut into count equal parts, the new parts are the delta's added notes.
+def split_notes(staff, notes, count, next_uid):
+    added = []
+    for note in notes:
+        duration = note.duration / count
+        for i in range(1, count):
+            added.append(entities.Note2(
+                uid = next_uid(),
+                position = note.position + duration * i,
+                duration = duration,
+                pitch = note.pitch,
+                timbre = note.timbre,
+            ))
+    return NoteDelta("split", staff.uid, [note.uid for note in notes],
+        {'duration': ([note.duration for note in notes], [note.duration / count for note in notes])},
+        added=added)
+
+def add_notes(staff, notes):
+    return NoteDelta("add notes", staff.uid, [], {}, added=notes)
+
+def erase_notes(staff, notes):
+    erased = set(map(id, notes))
+    at = [i for i, note in enumerate(staff.notes) if id(note) in erased]
+    return NoteDelta("erase", staff.uid, [], {},
+        removed=[staff.notes[i] for i in at], removed_at=at)
+
+# Oldest entries are dropped once the commands hold more than budget bytes,
+# the latest command is always kept.
 class History:
-    def __init__(self, document):
+    def __init__(self, document, budget=1 << 26):
         self.document = document
-        self.undo_stack = []
-        self.redo_stack = []
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = deque()
+        self.memory = 0
 
     def do(self, command):
+        for old in self.redo_stack:
+            self.memory -= old.size()
         self.redo_stack.clear()
         command.do(self.document)
+        if self.undo_stack and hasattr(self.undo_stack[-1], 'merge') and self.undo_stack[-1].merge(command):
+            return
         self.undo_stack.append(command)
+        self.memory += command.size()
+        while self.memory > self.budget and len(self.undo_stack) > 1:
+            self.memory -= self.undo_stack.popleft().size()
 
     def undo(self):
         command = self.undo_stack.pop()
@@ -31,3 +235,6 @@ class History:
         command = self.redo_stack.pop()
         command.do(self.document)
         self.undo_stack.append(command)
+
+    def memory_use(self):
+        return self.memory
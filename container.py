@@ -0,0 +1,161 @@
+"""
+    Document container
+    Patch blobs are kept uncompressed inside the zip, so they can be
+    memory-mapped on demand and copied through on save.
+    Other members are compressed on worker threads and assembled in order.
+"""
+import io
+import mmap
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+# Chunk size used when copying blobs through.
+COPY_CHUNK = 1 << 20
+
+# Compression level by kind of member, see member_kind.
+# Level 0 stores the member, patch blobs are stored so they can be mapped.
+COMPRESSION = {
+    'document': 6,
+    'track': 6,
+    'instrument': 6,
+    'patch': 0,
+}
+
+# Compressed members larger than this spill into a temporary file.
+SPOOL_SIZE = 1 << 23
+
+# The file is mapped right away, so the blobs keep reading the file the infos
+# describe after a save or a compaction has replaced it under the same name.
+class Container:
+    def __init__(self, filename, infos):
+        self.filename = filename
+        self.infos = dict((info.filename, info) for info in infos)
+        with open(self.filename, 'rb') as fd:
+            self.mapping = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def map(self):
+        return self.mapping
+
+    # Compressed members cannot be mapped, so they are read right away.
+    def blob(self, name):
+        info = self.infos[name]
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.filename, 'r') as zf:
+                return zf.read(info)
+        return StoredBlob(self, info)
+
+class StoredBlob:
+    def __init__(self, container, info):
+        self.container = container
+        self.info = info
+
+    def __len__(self):
+        return self.info.file_size
+
+    def view(self):
+        mapping = self.container.map()
+        offset = self.info.header_offset
+        # The local file header has variable length name and extra fields.
+        name_length, extra_length = struct.unpack_from('<HH', mapping, offset + 26)
+        start = offset + 30 + name_length + extra_length
+        return memoryview(mapping)[start:start + self.info.file_size]
+
+def blob_view(blob):
+    if isinstance(blob, StoredBlob):
+        return blob.view()
+    return blob
+
+# Older documents named patch blobs 'instrument.<name>.<n>.patch'.
+def member_kind(name):
+    if name.endswith('.patch'):
+        return 'patch'
+    return name.split('.', 1)[0]
+
+def compression_level(name, levels=COMPRESSION):
+    return levels[member_kind(name)]
+
+# A zip member compressed while it is written, closing it finishes the stream.
+# zlib and crc32 release the GIL, so members can be written from several threads.
+class Member(io.RawIOBase):
+    def __init__(self, name, level):
+        self.info = zipfile.ZipInfo(name, time.localtime()[:6])
+        self.info.external_attr = 0o600 << 16
+        self.info.file_size = 0
+        self.info.CRC = 0
+        if level == 0:
+            self.info.compress_type = zipfile.ZIP_STORED
+            self.compressor = None
+        else:
+            self.info.compress_type = zipfile.ZIP_DEFLATED
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.info.file_size += len(data)
+        self.info.CRC = zlib.crc32(data, self.info.CRC)
+        if self.compressor is not None:
+            self.spool.write(self.compressor.compress(data))
+        else:
+            self.spool.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self.compressor is not None:
+                self.spool.write(self.compressor.flush())
+            self.info.compress_size = self.spool.tell()
+            self.spool.seek(0)
+        super().close()
+
+    def copy_to(self, fd):
+        shutil.copyfileobj(self.spool, fd, COPY_CHUNK)
+        self.spool.close()
+
+# A stored blob that stays stored is copied through as it is.
+class StoredMember:
+    def __init__(self, name, blob):
+        self.info = zipfile.ZipInfo(name, time.localtime()[:6])
+        self.info.external_attr = 0o600 << 16
+        self.info.compress_type = zipfile.ZIP_STORED
+        self.info.file_size = len(blob)
+        self.info.compress_size = len(blob)
+        self.info.CRC = blob.info.CRC
+        self.blob = blob
+
+    def copy_to(self, fd):
+        view = self.blob.view()
+        for i in range(0, len(view), COPY_CHUNK):
+            fd.write(view[i:i + COPY_CHUNK])
+        view.release()
+
+def blob_member(name, blob, level):
+    if level == 0 and isinstance(blob, StoredBlob):
+        return StoredMember(name, blob)
+    with Member(name, level) as member:
+        view = memoryview(blob_view(blob))
+        for i in range(0, len(view), COPY_CHUNK):
+            member.write(view[i:i + COPY_CHUNK])
+        view.release()
+    return member
+
+# Writes finished members into a zip opened for writing, in the given order.
+def write_members(zf, members):
+    for member in members:
+        info = member.info
+        zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+        zf.fp.seek(zf.start_dir)
+        info.header_offset = zf.fp.tell()
+        zf.fp.write(info.FileHeader(zip64))
+        member.copy_to(zf.fp)
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+        zf.start_dir = zf.fp.tell()
+        zf._didModify = True
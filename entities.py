@@ -4,47 +4,84 @@
 """
 from fractions import Fraction
 import zipfile, json, io
+import struct, sys, os
 import bisect
+import threading
+import concurrent.futures
 import random
+import weakref
+from array import array
+from collections.abc import Iterator
+from itertools import islice
+import container
 
 class Document:
-    def __init__(self, track, instruments, next_uid):
+    def __init__(self, track, instruments, next_uid, journal_seq=0, track_format='json'):
         self.track = track
         self.instruments = instruments
         self.next_uid = next_uid
+        self.journal_seq = journal_seq # Last journal record folded into the container
+        self.track_format = track_format
         self.mutes = {}
 
+    # A copy that later edits do not reach, for saving on another thread.
+    # Pitches, fractions and patch blobs are never changed in place, so they are shared,
+    # and notes are shared until they change, see FrozenNotes.
+    def snapshot(self):
+        return Document(
+            track = self.track.snapshot(),
+            instruments = [instrument.snapshot() for instrument in self.instruments],
+            next_uid = UidGenerator(self.next_uid.next_uid),
+            journal_seq = self.journal_seq,
+            track_format = self.track_format,
+        )
+
     def init_plugins(self, pluginhost, block_length):
         plugins = {}
         for instrument in self.instruments:
             plugins[instrument.uid] = plugin = pluginhost.plugin(instrument.plugin, block_length)
             if len(instrument.patch) > 0:
-                plugin.restore(instrument.patch, instrument.data)
+                data = dict((path, container.blob_view(blob)) for path, blob in instrument.data.items())
+                plugin.restore(instrument.patch, data)
         return plugins
 
+    # Blob names are content hashes, so a blob that is already
+    # in the container is kept instead of the freshly stored copy.
     def store_plugins(self, plugins):
+        blobs = {}
+        for instrument in self.instruments:
+            blobs.update(instrument.data)
         for instrument in self.instruments:
-            i = f"instrument.{instrument.uid}"
-            instrument.patch, instrument.data = plugins[instrument.uid].store(i)
+            instrument.patch, data = plugins[instrument.uid].store()
+            instrument.data = dict((path, blobs.setdefault(path, blob)) for path, blob in data.items())
 
 def load_document(filename):
     with zipfile.ZipFile(filename, 'r') as zf:
+        source = container.Container(filename, zf.infolist())
         with zf.open('document.json', 'r') as fd:
             document_json = json.load(io.TextIOWrapper(fd, 'utf-8'))
-        with zf.open('track.json', 'r') as fd:
-            track_json = json.load(io.TextIOWrapper(fd, 'utf-8'))
+        if 'track.bin' in zf.namelist():
+            track_format = 'binary'
+            with zf.open('track.bin', 'r') as fd:
+                track = track_from_binary(fd)
+        else:
+            track_format = 'json'
+            with zf.open('track.json', 'r') as fd:
+                track = Track.from_json(json.load(io.TextIOWrapper(fd, 'utf-8')))
         instruments = []
         for uid in document_json['instrument_uids']:
             with zf.open(f'instrument.{uid}.json', 'r') as fd:
                 instrument_json = json.load(io.TextIOWrapper(fd, 'utf-8'))
-                instrument = Instrument.from_json(instrument_json, zf)
+                instrument = Instrument.from_json(instrument_json, source)
                 instrument.uid = uid
             instruments.append(instrument)
 
     document = Document(
-        track = Track.from_json(track_json),
+        track = track,
         instruments = instruments,
         next_uid = UidGenerator(document_json['next_uid']),
+        journal_seq = document_json.get('journal_seq', 0),
+        track_format = track_format,
     )
     for voice in document.track.voices:
         for graph in document.track.graphs:
@@ -63,30 +100,246 @@ def load_document(filename):
     document.track.voices = []
     return document
 
-def save_document(filename, document):
-    with zipfile.ZipFile(filename, 'w') as zf:
-        with zf.open('document.json', 'w') as fd:
-            document_json = {
-                'instrument_uids': [i.uid for i in document.instruments],
-                'next_uid': document.next_uid.next_uid,
-            }
-            json.dump(
-                document_json,
-                io.TextIOWrapper(fd, 'utf-8'),
-                sort_keys=True, indent=2)
-        with zf.open('track.json', 'w') as fd:
-            json.dump(
-                document.track.as_json(),
-                io.TextIOWrapper(fd, 'utf-8'),
-                sort_keys=True, indent=2)
-        for instrument in document.instruments:
-            with zf.open(f'instrument.{instrument.uid}.json', 'w') as fd:
-                json.dump(
-                    instrument.as_json(),
-                    io.TextIOWrapper(fd, 'utf-8'),
-                    sort_keys=True, indent=2)
-            for path, content in instrument.data.items():
-                zf.writestr(path, content)
+# track_format is either 'json' or 'binary', load_document detects which one was used.
+# By default the document is saved in the format it was loaded from.
+# The container is written next to the old one and renamed over it,
+# patch blobs that are still mapped from the old file are copied through.
+# progress(done, total) is called as the members get written.
+# The new file and the rename reach the disk before this returns,
+# so a journal truncated afterwards never outlives the container.
+def save_document(filename, document, track_format=None, progress=None, compression=None, workers=None):
+    track_format = track_format or document.track_format
+    temporary = f"{filename}.tmp"
+    try:
+        write_document(temporary, document, track_format, progress, compression, workers)
+        fsync_path(temporary)
+        os.replace(temporary, filename)
+        fsync_path(os.path.dirname(os.path.abspath(filename)))
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    # Blobs now live in the new file, so the old file can be let go.
+    with zipfile.ZipFile(filename, 'r') as zf:
+        target = container.Container(filename, zf.infolist())
+    for instrument in document.instruments:
+        instrument.data = dict((path, target.blob(path)) for path in instrument.data)
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Members are produced and compressed on a thread pool,
+# compression overrides container.COMPRESSION levels by kind of member.
+def write_document(filename, document, track_format, progress=None, compression=None, workers=None):
+    levels = dict(container.COMPRESSION, **(compression or {}))
+    total = 1 + len(document.track.graphs) + sum(1 + len(i.data) for i in document.instruments)
+    done = 0
+    lock = threading.Lock()
+    def step():
+        nonlocal done
+        with lock:
+            done += 1
+            if progress is not None:
+                progress(done, total)
+    def member(name):
+        return container.Member(name, container.compression_level(name, levels))
+
+    def write_document_json():
+        document_json = {
+            'instrument_uids': [i.uid for i in document.instruments],
+            'next_uid': document.next_uid.next_uid,
+            'journal_seq': document.journal_seq,
+        }
+        fd = member('document.json')
+        with io.TextIOWrapper(fd, 'utf-8') as text:
+            json.dump(document_json, text, sort_keys=True, indent=2)
+        step()
+        return fd
+
+    def write_track():
+        if track_format == 'binary':
+            with member('track.bin') as fd:
+                track_as_binary(document.track, fd, step)
+        else:
+            fd = member('track.json')
+            with io.TextIOWrapper(fd, 'utf-8') as text:
+                record = document.track.as_json(stream=True)
+                record['graphs'] = stepping(record['graphs'], step)
+                write_json(text, record)
+        return fd
+
+    def write_instrument(instrument):
+        fd = member(f'instrument.{instrument.uid}.json')
+        with io.TextIOWrapper(fd, 'utf-8') as text:
+            json.dump(instrument.as_json(), text, sort_keys=True, indent=2)
+        step()
+        return fd
+
+    def write_blob(path, blob, count):
+        fd = container.blob_member(path, blob, container.compression_level(path, levels))
+        for _ in range(count):
+            step()
+        return fd
+
+    if track_format not in ('binary', 'json'):
+        raise ValueError(track_format)
+    # A blob shared by several instruments is written once.
+    blobs = {}
+    counts = {}
+    for instrument in document.instruments:
+        for path, blob in instrument.data.items():
+            blobs.setdefault(path, blob)
+            counts[path] = counts.get(path, 0) + 1
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        members = [pool.submit(write_document_json), pool.submit(write_track)]
+        members.extend(pool.submit(write_instrument, instrument) for instrument in document.instruments)
+        members.extend(pool.submit(write_blob, path, blob, counts[path]) for path, blob in blobs.items())
+        with zipfile.ZipFile(filename, 'w') as zf:
+            container.write_members(zf, (future.result() for future in members))
+
+# Calls step after each item has been consumed.
+def stepping(items, step):
+    for item in items:
+        yield item
+        step()
+
+# Writes the same text as json.dump(record, fd, sort_keys=True, indent=2),
+# but iterators inside the record are written out as lists a batch at a time,
+# so the whole record never needs to exist in memory at once.
+json_encoder = json.JSONEncoder(sort_keys=True, indent=2)
+
+def is_streaming(record):
+    if isinstance(record, dict):
+        return any(is_streaming(value) for value in record.values())
+    return isinstance(record, Iterator)
+
+def write_json(fd, record, level=0, batch_size=1024):
+    indent = '\n' + '  ' * level
+    if isinstance(record, dict) and is_streaming(record):
+        separator = '{'
+        for key in sorted(record):
+            fd.write(separator + indent + '  ' + json.dumps(key) + ': ')
+            write_json(fd, record[key], level + 1, batch_size)
+            separator = ','
+        fd.write(indent + '}')
+    elif isinstance(record, Iterator):
+        separator = '['
+        batch = []
+        def flush():
+            nonlocal separator
+            if batch:
+                # Items of an encoded list, without the brackets.
+                text = json_encoder.encode(batch).replace('\n', indent)
+                fd.write(separator + text[1:-len(indent)-1])
+                separator = ','
+                batch.clear()
+        for item in record:
+            if is_streaming(item):
+                flush()
+                fd.write(separator + indent + '  ')
+                write_json(fd, item, level + 1, batch_size)
+                separator = ','
+            else:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    flush()
+        flush()
+        fd.write('[]' if separator == '[' else indent + ']')
+    else:
+        fd.write(json_encoder.encode(record).replace('\n', indent))
+
+# Binary track encoding.
+# The header is the JSON form of the track without staff notes,
+# the notes follow as packed little-endian integer columns, one set per staff.
+#   magic, u32 header length, header,
+#   for every staff: u32 note count, then per column: u32 byte length, data
+TRACK_MAGIC = b'RNTRACK1'
+NO_VALUE = -2**63 # Stands for None in the accidental and timbre columns
+NOTE_COLUMNS = [
+    ('uid', 'q'),
+    ('position_numerator', 'q'),
+    ('position_denominator', 'q'),
+    ('duration_numerator', 'q'),
+    ('duration_denominator', 'q'),
+    ('pitch_position', 'q'),
+    ('pitch_accidental', 'q'),
+    ('timbre', 'q'),
+]
+
+def track_as_binary(track, fd, step=lambda: None):
+    record = track.as_json(notes=False)
+    header = json.dumps(record, sort_keys=True).encode('utf-8')
+    fd.write(TRACK_MAGIC)
+    fd.write(struct.pack('<I', len(header)))
+    fd.write(header)
+    for graph in track.graphs:
+        if isinstance(graph, Staff):
+            fd.write(struct.pack('<I', len(graph.notes)))
+            for column in notes_as_columns(graph.notes):
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                fd.write(struct.pack('<I', len(column) * column.itemsize))
+                fd.write(column)
+        step()
+
+def track_from_binary(fd):
+    if fd.read(len(TRACK_MAGIC)) != TRACK_MAGIC:
+        raise ValueError("not a binary track")
+    length, = struct.unpack('<I', fd.read(4))
+    track = Track.from_json(json.loads(fd.read(length).decode('utf-8')))
+    for graph in track.graphs:
+        if isinstance(graph, Staff):
+            count, = struct.unpack('<I', fd.read(4))
+            columns = []
+            for name, typecode in NOTE_COLUMNS:
+                size, = struct.unpack('<I', fd.read(4))
+                column = array(typecode)
+                column.frombytes(fd.read(size))
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                if len(column) != count:
+                    raise ValueError(f"truncated column {name!r}")
+                columns.append(column)
+            graph.notes = notes_from_columns(columns)
+    return track
+
+def notes_as_columns(notes):
+    columns = [array(typecode) for name, typecode in NOTE_COLUMNS]
+    uid, pn, pd, dn, dd, pp, pa, timbre = columns
+    for note in notes:
+        uid.append(note.uid)
+        n, d = note.position.as_integer_ratio()
+        pn.append(n)
+        pd.append(d)
+        n, d = note.duration.as_integer_ratio()
+        dn.append(n)
+        dd.append(d)
+        pp.append(note.pitch.position)
+        pa.append(NO_VALUE if note.pitch.accidental is None else note.pitch.accidental)
+        timbre.append(NO_VALUE if note.timbre is None else note.timbre)
+    return columns
+
+def notes_from_columns(columns):
+    notes = []
+    pitches = {}
+    for uid, pn, pd, dn, dd, pp, pa, timbre in zip(*columns):
+        accidental = None if pa == NO_VALUE else pa
+        try:
+            pitch = pitches[pp, accidental]
+        except KeyError:
+            pitch = pitches[pp, accidental] = Pitch(pp, accidental)
+        notes.append(Note2(
+            uid = uid,
+            position = Fraction(pn, pd),
+            duration = Fraction(dn, dd),
+            pitch = pitch,
+            timbre = None if timbre == NO_VALUE else timbre,
+        ))
+    return notes
 
 class Track:
     def __init__(self, graphs, voices):
@@ -100,9 +353,21 @@ class Track:
             voices = [Voice.from_json(a) for a in record.get('voices', [])],
         )
 
-    def as_json(self):
+    def snapshot(self):
+        return Track(
+            graphs = [graph.snapshot() for graph in self.graphs],
+            voices = list(self.voices),
+        )
+
+    # Legacy voices are converted to notes on load, so only the graphs count.
+    def content_hash(self):
+        return hash(tuple(graph.content_hash() for graph in self.graphs))
+
+    # With stream=True the graphs and notes are produced lazily for write_json.
+    def as_json(self, notes=True, stream=False):
+        graphs = (graph.as_json(notes, stream) for graph in self.graphs)
         return {
-            'graphs': [graph.as_json() for graph in self.graphs],
+            'graphs': graphs if stream else list(graphs),
             'voices': [voice.as_json() for voice in self.voices],
         }
 
@@ -134,7 +399,13 @@ class ChordProgression:
         self.uid = uid
         self.segments = segments
 
-    def as_json(self):
+    def snapshot(self):
+        return ChordProgression(self.uid, [ChordProgressionSegment(s.nth, s.duration) for s in self.segments])
+
+    def content_hash(self):
+        return hash(('chord_progression', self.uid, tuple((s.nth, s.duration) for s in self.segments)))
+
+    def as_json(self, notes=True, stream=False):
         return {
             'type': 'chord_progression',
             'uid': self.uid,
@@ -166,7 +437,13 @@ class Envelope:
         self.kind = kind
         self.segments = segments
 
-    def as_json(self):
+    def snapshot(self):
+        return Envelope(self.uid, self.kind, [EnvelopeSegment(s.control, s.value, s.duration) for s in self.segments])
+
+    def content_hash(self):
+        return hash(('envelope', self.uid, self.kind, tuple((s.control, s.value, s.duration) for s in self.segments)))
+
+    def as_json(self, notes=True, stream=False):
         return {
             'type': 'envelope',
             'uid': self.uid,
@@ -204,15 +481,231 @@ class Staff:
         self.blocks = blocks
         self.notes  = notes
 
-    def as_json(self):
-        return {
+    @property
+    def notes(self):
+        return self._notes
+
+    @notes.setter
+    def notes(self, notes):
+        self._notes = notes if isinstance(notes, (NoteList, FrozenNotes)) else NoteList(notes)
+
+    # Everything but the notes.
+    def header_hash(self):
+        blocks = tuple((b.beat, b.beats_in_measure, b.beat_unit, b.canonical_key, b.clef, b.mode) for b in self.blocks)
+        return hash(('staff', self.uid, self.top, self.bot, blocks))
+
+    def content_hash(self):
+        return hash((self.header_hash(), self.notes.content_hash()))
+
+    def snapshot(self):
+        return Staff(
+            uid = self.uid,
+            top = self.top,
+            bot = self.bot,
+            blocks = [StaffBlock(b.beat, b.beats_in_measure, b.beat_unit, b.canonical_key, b.clef, b.mode)
+                      for b in self.blocks],
+            notes = self.notes.freeze(),
+        )
+
+    def as_json(self, notes=True, stream=False):
+        record = {
             'type': "staff",
             'uid': self.uid,
             'top': self.top,
             'bot': self.bot,
             'blocks': [block.as_json() for block in self.blocks],
-            'notes': [note.as_json() for note in self.notes],
         }
+        if notes and stream:
+            record['notes'] = map(Note2.as_json, self.notes)
+        elif notes:
+            record['notes'] = [note.as_json() for note in self.notes]
+        return record
+
+# The notes of a staff. The content hash is a sum of note hashes, so that it is
+# kept up to date in O(1) per edit once it has been asked for the first time.
+# The index by uid is likewise built on first use and kept up to date after.
+# Once changed is set to a set, the uids of added, removed and changed notes are collected in it.
+DIGEST_MASK = (1 << 64) - 1
+
+class NoteList(list):
+    def __init__(self, notes=()):
+        super().__init__(notes)
+        self.digest = None
+        self.index = None
+        self.changed = None
+        self.frozen = None # FrozenNotes taken of the list and still in use
+        for note in self:
+            note.__dict__['owner'] = self
+
+    # Each note keeps the hash it was counted with, so forgetting it needs no rehash.
+    def content_hash(self):
+        if self.digest is None:
+            digest = 0
+            for note in self:
+                note.__dict__['digest'] = h = note.content_hash()
+                digest += h
+            self.digest = digest & DIGEST_MASK
+        return self.digest
+
+    def freeze(self):
+        frozen = FrozenNotes(self)
+        if self.frozen is None:
+            self.frozen = weakref.WeakSet()
+        self.frozen.add(frozen)
+        return frozen
+
+    def by_uid(self, uid):
+        if self.index is None:
+            self.index = dict((note.uid, note) for note in self)
+        return self.index[uid]
+
+    # Called before and after a note in the list changes.
+    def forget(self, note):
+        if self.frozen:
+            for frozen in self.frozen:
+                frozen.preserve(note)
+        if self.changed is not None:
+            self.changed.add(note.uid)
+        if self.digest is not None:
+            self.digest = (self.digest - note.digest) & DIGEST_MASK
+        if self.index is not None:
+            self.index.pop(note.uid, None)
+
+    def remember(self, note):
+        if self.changed is not None:
+            self.changed.add(note.uid)
+        if self.digest is not None:
+            note.__dict__['digest'] = h = note.content_hash()
+            self.digest = (self.digest + h) & DIGEST_MASK
+        if self.index is not None:
+            self.index[note.uid] = note
+
+    def adopt(self, notes):
+        for note in notes:
+            note.__dict__['owner'] = self
+            self.remember(note)
+
+    def release(self, notes):
+        for note in notes:
+            if note.owner is self:
+                note.__dict__['owner'] = None
+            self.forget(note)
+
+    # Removes many notes in one pass over the list.
+    def discard(self, notes):
+        notes = set(map(id, notes))
+        kept = [note for note in self if id(note) not in notes]
+        self.release([note for note in self if id(note) in notes])
+        super().__setitem__(slice(None), kept)
+
+    # Removes the notes at the given ascending indices in one pass.
+    def delete_at(self, indices):
+        drop = set(indices)
+        self.release([self[i] for i in indices])
+        super().__setitem__(slice(None), [note for i, note in enumerate(self) if i not in drop])
+
+    # Puts the notes at the given ascending indices of the resulting list in one pass,
+    # indices past the end append.
+    def insert_at(self, indices, notes):
+        rest = iter(list(self))
+        result = []
+        for index, note in zip(indices, notes):
+            result.extend(islice(rest, max(0, index - len(result))))
+            result.append(note)
+        result.extend(rest)
+        super().__setitem__(slice(None), result)
+        self.adopt(notes)
+
+    def append(self, note):
+        super().append(note)
+        self.adopt([note])
+
+    def extend(self, notes):
+        notes = list(notes)
+        super().extend(notes)
+        self.adopt(notes)
+
+    def __iadd__(self, notes):
+        self.extend(notes)
+        return self
+
+    def insert(self, index, note):
+        super().insert(index, note)
+        self.adopt([note])
+
+    def remove(self, note):
+        super().remove(note)
+        self.release([note])
+
+    def pop(self, index=-1):
+        note = super().pop(index)
+        self.release([note])
+        return note
+
+    def clear(self):
+        self.release(self)
+        super().clear()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self.release(self[index])
+        else:
+            self.release([self[index]])
+            value = [value]
+        super().__setitem__(index, value if isinstance(index, slice) else value[0])
+        self.adopt(value)
+
+    def __delitem__(self, index):
+        self.release(self[index] if isinstance(index, slice) else [self[index]])
+        super().__delitem__(index)
+
+# The notes of a NoteList as they were when frozen, read on another thread.
+# Taking one copies the list but not the notes. A note about to change
+# or leave the list leaves a copy of itself here first. Notes are read
+# through copies made under the lock, so a read never sees half an edit.
+# The digest carries over from the list when it has one, and the index
+# by uid is built on first use, both never change after.
+class FrozenNotes:
+    def __init__(self, notes):
+        self.lock = threading.Lock()
+        self.notes = list(notes)
+        self.saved = {} # id of a shared note -> its copy from before the change
+        self.digest = getattr(notes, 'digest', None)
+        self.index = None
+
+    def content_hash(self):
+        if self.digest is None:
+            self.digest = sum(note.content_hash() for note in self) & DIGEST_MASK
+        return self.digest
+
+    # Nothing reaches a frozen list, so it can stand for its own snapshot.
+    def freeze(self):
+        return self
+
+    def by_uid(self, uid):
+        if self.index is None:
+            self.index = dict((note.uid, note) for note in self)
+        return self.index[uid]
+
+    def preserve(self, note):
+        with self.lock:
+            if id(note) not in self.saved:
+                self.saved[id(note)] = copy_note(note)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __iter__(self):
+        for note in self.notes:
+            with self.lock:
+                saved = self.saved.get(id(note))
+                if saved is None:
+                    saved = copy_note(note)
+            yield saved
+
+def copy_note(note):
+    return Note2(note.uid, note.position, note.duration, note.pitch, note.timbre)
 
 # Staff is required to have at least one at beat=0, with all parameters present.
 # In later blocks the parameters may fill up from the previous blocks.
@@ -235,10 +728,12 @@ class StaffBlock:
             opt(self.mode, source.mode)
         )
 
+    # Beats that fall between whole numbers are stored as a ratio.
     @staticmethod
     def from_json(record):
+        beat = record['beat']
         return StaffBlock(
-            beat = record['beat'],
+            beat = Fraction(*beat) if isinstance(beat, list) else beat,
             beats_in_measure = record['beats_in_measure'],
             beat_unit = record['beat_unit'],
             canonical_key = record['canonical_key'],
@@ -247,8 +742,11 @@ class StaffBlock:
         )
 
     def as_json(self):
+        beat = self.beat
+        if isinstance(beat, Fraction):
+            beat = beat.numerator if beat.denominator == 1 else beat.as_integer_ratio()
         return {
-            'beat': self.beat,
+            'beat': beat,
             'beats_in_measure': self.beats_in_measure,
             'beat_unit': self.beat_unit,
             'canonical_key': self.canonical_key,
@@ -275,6 +773,71 @@ def at_beat(blocks, beat):
     else:
         return blocks[i-1], None
 
+# Measures restart at every block and repeat past the last one,
+# so the map stores one row per block and resolves measures exactly
+# with Fraction arithmetic instead of stepping through the barlines.
+class MeasureMap:
+    def __init__(self, smeared):
+        self.beats = []   # Start beat of each block
+        self.lengths = [] # Measure length within each block
+        self.firsts = []  # Index of the first measure of each block
+        count = 0
+        for i, block in enumerate(smeared):
+            beat = Fraction(block.beat)
+            length = Fraction(block.beats_in_measure)
+            self.beats.append(beat)
+            self.lengths.append(length)
+            self.firsts.append(count)
+            if i + 1 < len(smeared):
+                count += -((beat - Fraction(smeared[i+1].beat)) // length)
+
+    def block_index(self, beat):
+        return max(0, bisect.bisect_right(self.beats, beat) - 1)
+
+    def index(self, beat):
+        i = self.block_index(beat)
+        return self.firsts[i] + int((Fraction(beat) - self.beats[i]) // self.lengths[i])
+
+    def start(self, index):
+        i = max(0, bisect.bisect_right(self.firsts, index) - 1)
+        return self.beats[i] + (index - self.firsts[i]) * self.lengths[i]
+
+    def length(self, index):
+        i = max(0, bisect.bisect_right(self.firsts, index) - 1)
+        start = self.beats[i] + (index - self.firsts[i]) * self.lengths[i]
+        if i + 1 < len(self.beats):
+            return min(self.lengths[i], self.beats[i+1] - start)
+        return self.lengths[i]
+
+    # Start and length of the measure containing the beat.
+    def measure(self, beat):
+        index = self.index(beat)
+        return self.start(index), self.length(index)
+
+    # Breaks a duration into pieces that do not cross barlines.
+    def split(self, position, duration):
+        beat = Fraction(position)
+        stop = beat + Fraction(duration)
+        index = self.index(beat)
+        while beat < stop:
+            end = min(self.start(index) + self.length(index), stop)
+            yield beat, end - beat
+            beat = end
+            index += 1
+
+    # Barlines that fall inside blocks, the final block continuing up to stop.
+    def barlines(self, stop):
+        for i, length in enumerate(self.lengths):
+            beat = self.beats[i] + length
+            if i + 1 < len(self.beats):
+                while beat < self.beats[i+1]:
+                    yield beat
+                    beat += length
+            else:
+                while beat <= stop:
+                    yield beat
+                    beat += length
+
 class Voice:
     def __init__(self, uid, staff_uid, dynamics_uid, segments):
         self.uid = uid
@@ -325,12 +888,16 @@ class Instrument:
         self.data = data
         self.uid = uid
 
+    def snapshot(self):
+        return Instrument(self.plugin, self.patch, dict(self.data), self.uid)
+
+    # Patch blobs are not read here, they are mapped from the container when needed.
     @staticmethod
-    def from_json(record, zf):
+    def from_json(record, source):
         patch = record['patch']
         data = {}
         for row in patch.values():
-            data[ row['path'] ] = zf.read(row['path'])
+            data[ row['path'] ] = source.blob(row['path'])
         return Instrument(
             plugin = record['plugin'],
             patch = patch,
@@ -365,14 +932,34 @@ class Note:
         }
 
 class Note2:
+    owner = None # NoteList holding the note
+    digest = None # Hash the owner counted the note with
+
     def __init__(self, uid, position, duration, pitch, timbre):
-        self.uid = uid
-        self.position = position
-        self.duration = duration
-        self.pitch = pitch
-        self.timbre = timbre
+        # A new note has no owner to notify, so the fields skip __setattr__.
+        fields = self.__dict__
+        fields['uid'] = uid
+        fields['position'] = position
+        fields['duration'] = duration
+        fields['pitch'] = pitch
+        fields['timbre'] = timbre
         assert duration != 0
 
+    # Edits made straight to a note keep the content hash and the index of its staff up to date.
+    def __setattr__(self, name, value):
+        owner = self.owner
+        if owner is None or name == 'owner' or name == 'digest':
+            object.__setattr__(self, name, value)
+        else:
+            owner.forget(self)
+            object.__setattr__(self, name, value)
+            owner.remember(self)
+
+    # Ratios hash faster than Fractions do, and equal for equal values.
+    def content_hash(self):
+        return hash((self.uid, self.position.as_integer_ratio(), self.duration.as_integer_ratio(),
+                     self.pitch.position, self.pitch.accidental, self.timbre))
+
     @staticmethod
     def from_json(record):
         position, accidental = record['pitch']
@@ -381,7 +968,7 @@ class Note2:
         position = Fraction(numerator, denominator)
         numerator, denominator = record['duration']
         duration = Fraction(numerator, denominator)
-        return Note(
+        return Note2(
             uid = record['uid'],
             position = position,
             duration = duration,
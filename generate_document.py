@@ -0,0 +1,162 @@
+"""
+    Synthetic document generator for benchmarks.
+    The same arguments and seed always give the same document.
+
+    Notes share their Fraction and Pitch objects, a million notes
+    take about 350 MB at peak while generating and saving.
+"""
+from fractions import Fraction
+from entities import *
+import argparse
+import random
+
+# Positions fall on a grid fine enough for the tuplets below.
+GRID = 240
+DURATIONS = [Fraction(1, 4), Fraction(1, 2), Fraction(1), Fraction(1), Fraction(2)]
+TUPLETS = [(3, 2), (5, 4)] # notes in the time of
+BAR = 12 # Key and meter changes fall on multiples of this many beats
+
+# Uids from the shared generator are random, these are sequential.
+class SequentialUids(UidGenerator):
+    def __call__(self):
+        uid = self.next_uid
+        self.next_uid += 1
+        return uid
+
+class Fractions:
+    def __init__(self):
+        self.cache = {}
+
+    def __call__(self, ticks):
+        try:
+            return self.cache[ticks]
+        except KeyError:
+            value = self.cache[ticks] = Fraction(ticks, GRID)
+            return value
+
+class Pitches:
+    def __init__(self):
+        self.cache = {}
+
+    def __call__(self, position, accidental):
+        try:
+            return self.cache[position, accidental]
+        except KeyError:
+            value = self.cache[position, accidental] = Pitch(position, accidental)
+            return value
+
+# One monophonic line, durations and pitches from a random walk.
+def generate_voice(rng, count, register, tuplet_density, fraction, pitch, next_uid, timbre):
+    notes = []
+    ticks = 0
+    position = register
+    while len(notes) < count:
+        if rng.random() < tuplet_density:
+            n, m = rng.choice(TUPLETS)
+            unit = int(rng.choice(DURATIONS[:3]) * GRID)
+            durations = [unit * m // n] * n
+        else:
+            durations = [int(rng.choice(DURATIONS) * GRID)]
+        for duration in durations[:count - len(notes)]:
+            position = max(register - 7, min(register + 7, position + rng.choice([-2, -1, -1, 0, 1, 1, 2])))
+            accidental = rng.choice([None] * 8 + [-1, 1])
+            notes.append(Note2(
+                uid = next_uid(),
+                position = fraction(ticks),
+                duration = fraction(duration),
+                pitch = pitch(position, accidental),
+                timbre = timbre,
+            ))
+            ticks += duration
+            # Occasional rests
+            if rng.random() < 0.05:
+                ticks += int(rng.choice(DURATIONS[:2]) * GRID)
+    return notes, ticks
+
+def generate_blocks(rng, length, key_changes, meter_changes):
+    blocks = [StaffBlock(beat=0, beats_in_measure=rng.choice([3, 4]), beat_unit=4,
+                         canonical_key=rng.randrange(-7, 8), clef=3, mode=None)]
+    changes = {}
+    bars = max(1, int(length // BAR))
+    for i in range(key_changes):
+        changes.setdefault(BAR * (bars * (i+1) // (key_changes+1)), {})['canonical_key'] = rng.randrange(-7, 8)
+    for i in range(meter_changes):
+        changes.setdefault(BAR * (bars * (2*i+1) // (2*meter_changes+1)), {})['beats_in_measure'] = rng.choice([2, 3, 4, 6])
+    # Short documents put changes on beat 0, they replace the opening values.
+    for name, value in changes.pop(0, {}).items():
+        setattr(blocks[0], name, value)
+    for beat in sorted(changes):
+        blocks.append(StaffBlock(beat=beat, **changes[beat]))
+    return blocks
+
+def generate_envelope(rng, next_uid, kind, length, low, high):
+    segments = []
+    beat = 0
+    # An empty document still gets one segment.
+    while beat < length or not segments:
+        duration = rng.choice([4, 8, 16])
+        control = rng.choice([0, 0, 1, -1])
+        segments.append(EnvelopeSegment(control, None if control else rng.uniform(low, high), Fraction(duration)))
+        beat += duration
+    segments[0].control = 0
+    segments[0].value = (low + high) / 2
+    return Envelope(next_uid(), kind, segments)
+
+def generate_chords(rng, next_uid, length):
+    segments = []
+    beat = 0
+    while beat < length or not segments:
+        duration = rng.choice([2, 4, 4, 8])
+        segments.append(ChordProgressionSegment(rng.randrange(7), Fraction(duration)))
+        beat += duration
+    return ChordProgression(next_uid(), segments)
+
+def generate(staves=4, notes_per_staff=1000, polyphony=2, tuplet_density=0.1,
+             key_changes=2, meter_changes=2, envelopes=True, chords=True, timbre=600, seed=0):
+    rng = random.Random(seed)
+    next_uid = SequentialUids(1000)
+    fraction = Fractions()
+    pitch = Pitches()
+    graphs = []
+    length = 0
+    for s in range(staves):
+        notes = []
+        staff_length = 0
+        for v in range(polyphony):
+            count = notes_per_staff // polyphony + (v < notes_per_staff % polyphony)
+            register = 21 + 21 * s // max(1, staves - 1) + 5 * v if staves > 1 else 28 + 5 * v
+            voice, ticks = generate_voice(rng, count, register, tuplet_density, fraction, pitch, next_uid, timbre)
+            notes.extend(voice)
+            staff_length = max(staff_length, Fraction(ticks, GRID))
+        notes.sort(key=lambda note: note.position)
+        graphs.append(Staff(next_uid(), 3, 2, generate_blocks(rng, staff_length, key_changes, meter_changes), notes))
+        length = max(length, staff_length)
+    if envelopes:
+        graphs.append(generate_envelope(rng, next_uid, 'tempo', length, 60, 180))
+        graphs.append(generate_envelope(rng, next_uid, 'dynamics', length, 0.3, 1.0))
+    if chords:
+        graphs.append(generate_chords(rng, next_uid, length))
+    return Document(
+        track = Track(graphs, []),
+        instruments = [],
+        next_uid = next_uid,
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename')
+    parser.add_argument('--staves', type=int, default=4)
+    parser.add_argument('--notes', type=int, default=1000, help="notes per staff")
+    parser.add_argument('--polyphony', type=int, default=2, help="voices per staff")
+    parser.add_argument('--tuplets', type=float, default=0.1, help="chance of a tuplet group")
+    parser.add_argument('--key-changes', type=int, default=2)
+    parser.add_argument('--meter-changes', type=int, default=2)
+    parser.add_argument('--no-envelopes', action='store_true')
+    parser.add_argument('--no-chords', action='store_true')
+    parser.add_argument('--format', choices=['json', 'binary'], default='binary')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    document = generate(args.staves, args.notes, args.polyphony, args.tuplets,
+                        args.key_changes, args.meter_changes,
+                        not args.no_envelopes, not args.no_chords, seed=args.seed)
+    save_document(args.filename, document, args.format)
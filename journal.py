@@ -0,0 +1,320 @@
+"""
+    Edit journal
+    Track edits are appended to a journal next to the container,
+    and folded back into the container by compaction.
+    Staves are journaled by the notes that changed, other graphs whole.
+    Records are gathered on the editing thread and written on a worker thread.
+    Instruments and their patches are only written by a full save.
+"""
+import concurrent.futures
+import entities
+import json
+import os
+import threading
+
+# A compaction folded newer records into the container before the snapshot was written.
+class StaleSnapshot(Exception):
+    pass
+
+class Journal:
+    def __init__(self, filename, compact_size=1 << 22):
+        self.filename = filename
+        self.path = f"{filename}.journal"
+        self.compact_size = compact_size # Journal size that triggers compaction
+        self.lock = threading.Lock()     # Guards the journal file
+        self.saving = threading.Lock()   # Held while the container is rewritten
+        self.compactor = None
+        self.saver = None
+        self.save_progress = None # Fraction of the background save written, None when idle
+        self.save_result = None   # Saved snapshot or the exception, until polled
+        self.save_format = None
+        self.container_seq = 0    # journal_seq of the container on disk
+        self.writer = concurrent.futures.ThreadPoolExecutor(1)
+        self.write_error = None
+        self.seq = 0
+        self.written = 0 # Last seq in the journal file
+        self.digests = {}
+        self.tracked = {} # staff uid -> NoteList collecting its changes
+        self.headers = {} # staff uid -> header_hash of the tracked staff
+        self.uids = []
+        self.next_uid = None
+        self.fd = None
+
+    # Loads the last compacted container and replays the journal on top of it.
+    def load(self):
+        document = entities.load_document(self.filename)
+        self.seq = document.journal_seq
+        for record in read_records(self.path):
+            if record['seq'] > document.journal_seq:
+                apply_record(document, record)
+                self.seq = record['seq']
+        self.written = self.seq
+        self.container_seq = document.journal_seq
+        self.truncate(document.journal_seq)
+        self.mark(document)
+        return document
+
+    # Remembers the document state the journal and the container describe.
+    def mark(self, document):
+        for notes in self.tracked.values():
+            notes.changed = None
+        self.digests = dict((graph.uid, graph_digest(graph)) for graph in document.track.graphs)
+        self.tracked = {}
+        self.headers = {}
+        for graph in document.track.graphs:
+            if isinstance(graph, entities.Staff):
+                self.track(graph)
+        self.uids = [graph.uid for graph in document.track.graphs]
+        self.next_uid = document.next_uid.next_uid
+
+    def track(self, staff):
+        previous = self.tracked.get(staff.uid)
+        if previous is not None:
+            previous.changed = None
+        staff.notes.changed = set()
+        self.tracked[staff.uid] = staff.notes
+        self.headers[staff.uid] = staff.header_hash()
+
+    # Gathers records for whatever changed since the previous flush,
+    # in time proportional to the change, and queues them for writing.
+    def flush(self, document):
+        if self.write_error is not None:
+            error, self.write_error = self.write_error, None
+            raise error
+        records = []
+        for graph in document.track.graphs:
+            notes = self.tracked.get(graph.uid)
+            if notes is not None and notes is graph.notes:
+                header = graph.header_hash()
+                if self.headers[graph.uid] != header:
+                    self.headers[graph.uid] = header
+                    records.append({'staff': graph.as_json(notes=False)})
+                if notes.changed:
+                    records.append(notes_record(graph, notes.changed))
+                    notes.changed = set()
+                continue
+            # Graphs other than staves, and staves whose note list was replaced.
+            digest = graph_digest(graph)
+            if self.digests.get(graph.uid) != digest:
+                self.digests[graph.uid] = digest
+                records.append({'graph': graph.as_json()})
+            if isinstance(graph, entities.Staff):
+                self.track(graph)
+        uids = [graph.uid for graph in document.track.graphs]
+        if uids != self.uids:
+            self.uids = uids
+            for uid in set(self.digests) - set(uids):
+                self.digests.pop(uid)
+            for uid in set(self.tracked) - set(uids):
+                self.tracked.pop(uid).changed = None
+                self.headers.pop(uid)
+            records.append({'graphs': uids})
+        if document.next_uid.next_uid != self.next_uid:
+            self.next_uid = document.next_uid.next_uid
+            records.append({'next_uid': self.next_uid})
+        if records:
+            with self.lock:
+                for record in records:
+                    self.seq += 1
+                    record['seq'] = self.seq
+            self.writer.submit(self.write, records)
+        return len(records)
+
+    def write(self, records):
+        try:
+            lines = ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records)
+            with self.lock:
+                if self.fd is None:
+                    self.fd = open(self.path, 'a', encoding='utf-8')
+                self.fd.write(lines)
+                self.fd.flush()
+                self.written = records[-1]['seq']
+                size = self.fd.tell()
+        except Exception as error:
+            self.write_error = error
+            return
+        if size >= self.compact_size:
+            self.compact_in_background()
+
+    # Full save, the journal is left empty afterwards.
+    def save(self, document, track_format=None):
+        with self.saving:
+            with self.lock:
+                document.journal_seq = self.seq
+            entities.save_document(self.filename, document, track_format)
+            self.container_seq = document.journal_seq
+            self.truncate(document.journal_seq)
+            self.mark(document)
+
+    # Saves a snapshot of the document on a worker thread, editing may continue meanwhile.
+    # Returns False if a save is already running.
+    def save_in_background(self, document, track_format=None):
+        if self.saver is not None and self.saver.is_alive():
+            return False
+        snapshot = document.snapshot()
+        with self.lock:
+            snapshot.journal_seq = self.seq
+        # The digests are left alone, so later flushes journal the edits
+        # made while the snapshot is being written under newer seq numbers.
+        self.save_progress = 0.0
+        self.save_result = None
+        self.save_format = track_format
+        self.saver = threading.Thread(target=self.save_snapshot, args=(snapshot, track_format), daemon=True)
+        self.saver.start()
+        return True
+
+    def save_snapshot(self, snapshot, track_format):
+        def progress(done, total):
+            self.save_progress = done / total
+        try:
+            with self.saving:
+                # Writing the older snapshot would drop the records the compaction folded in.
+                if self.container_seq > snapshot.journal_seq:
+                    raise StaleSnapshot()
+                entities.save_document(self.filename, snapshot, track_format, progress)
+                self.container_seq = snapshot.journal_seq
+                self.truncate(snapshot.journal_seq)
+            self.save_result = snapshot
+        except Exception as error:
+            self.save_result = error
+
+    # Called from the GUI thread, returns a status line while a save is going on.
+    def poll_save(self, document):
+        if self.save_progress is None:
+            return None
+        result = self.save_result
+        if result is None:
+            return f"saving {round(self.save_progress * 100)}%"
+        self.save_progress = None
+        self.save_result = None
+        if isinstance(result, StaleSnapshot):
+            # A fresh snapshot is past the compaction.
+            self.saver.join()
+            self.save_in_background(document, self.save_format)
+            return "saving 0%"
+        if isinstance(result, Exception):
+            # The journal was not truncated, nothing is lost.
+            return f"save failed: {result}"
+        document.journal_seq = result.journal_seq
+        # Instruments not stored again since the snapshot now map their blobs from the new file.
+        saved = dict((instrument.uid, instrument) for instrument in result.instruments)
+        for instrument in document.instruments:
+            other = saved.get(instrument.uid)
+            if other is not None and other.patch is instrument.patch:
+                instrument.data = other.data
+        return "saved"
+
+    def compact_in_background(self):
+        if self.compactor is None or not self.compactor.is_alive():
+            self.compactor = threading.Thread(target=self.compact, daemon=True)
+            self.compactor.start()
+
+    # Folds the journal into a fresh container without touching the live document,
+    # so this can run on a worker thread while edits keep being appended.
+    # Records still waiting for the writer are left for the next compaction.
+    def compact(self):
+        with self.saving:
+            with self.lock:
+                seq = self.written
+            document = entities.load_document(self.filename)
+            for record in read_records(self.path):
+                if document.journal_seq < record['seq'] <= seq:
+                    apply_record(document, record)
+            document.journal_seq = seq
+            entities.save_document(self.filename, document)
+            self.container_seq = seq
+            self.truncate(seq)
+
+    # Drops the records a container already contains, through an atomic rename.
+    def truncate(self, seq):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+            keep = [record for record in read_records(self.path) if record['seq'] > seq]
+            temporary = f"{self.path}.tmp"
+            with open(temporary, 'w', encoding='utf-8') as fd:
+                for record in keep:
+                    fd.write(json.dumps(record, sort_keys=True) + '\n')
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(temporary, self.path)
+
+    def close(self):
+        self.writer.shutdown()
+        if self.saver is not None:
+            self.saver.join()
+        if self.compactor is not None:
+            self.compactor.join()
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+
+def graph_digest(graph):
+    return graph.content_hash()
+
+# Changed notes are stored whole, notes no longer in the staff by uid.
+def notes_record(staff, uids):
+    notes = []
+    removed = []
+    for uid in uids:
+        try:
+            notes.append(staff.notes.by_uid(uid).as_json())
+        except KeyError:
+            removed.append(uid)
+    return {'notes': staff.uid, 'set': notes, 'remove': removed}
+
+# A crash may leave the last line half written, it is ignored.
+def read_records(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as fd:
+        for line in fd:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+def apply_record(document, record):
+    graphs = document.track.graphs
+    if 'staff' in record:
+        header = entities.graph_from_json(record['staff'])
+        staff = next(graph for graph in graphs if graph.uid == header.uid)
+        staff.top = header.top
+        staff.bot = header.bot
+        staff.blocks = header.blocks
+    if 'notes' in record:
+        notes = next(graph for graph in graphs if graph.uid == record['notes']).notes
+        removed = []
+        for uid in record['remove']:
+            try:
+                removed.append(notes.by_uid(uid))
+            except KeyError:
+                pass
+        if removed:
+            notes.discard(removed)
+        added = []
+        for row in record['set']:
+            note = entities.Note2.from_json(row)
+            try:
+                old = notes.by_uid(note.uid)
+            except KeyError:
+                added.append(note)
+                continue
+            for field in ('position', 'duration', 'pitch', 'timbre'):
+                setattr(old, field, getattr(note, field))
+        notes.extend(added)
+    if 'graph' in record:
+        graph = entities.graph_from_json(record['graph'])
+        for i, other in enumerate(graphs):
+            if other.uid == graph.uid:
+                graphs[i] = graph
+                break
+        else:
+            graphs.append(graph)
+    if 'graphs' in record:
+        by_uid = dict((graph.uid, graph) for graph in graphs)
+        document.track.graphs = [by_uid[uid] for uid in record['graphs']]
+    if 'next_uid' in record:
+        document.next_uid.next_uid = record['next_uid']
@@ -1,6 +1,7 @@
 import lilv
 import ctypes
 import urllib.parse
+import hashlib
 import os
 import numpy
 import sdl2
@@ -169,7 +170,7 @@ class Plugin:
             type_p[0] = self.get_urid(pd['type'])
             dt = data[pd['path']]
             size_p[0] = len(dt)
-            custom_data = (ctypes.c_char * len(dt))(*dt)
+            custom_data = (ctypes.c_char * len(dt)).from_buffer_copy(dt)
             return ctypes.addressof(custom_data)
         k = self.state[0].restore(
                         self.instance.get_handle(),
@@ -179,21 +180,22 @@ class Plugin:
                         None)
         assert k == 0
 
-    def store(self, name = 'instrument'):
+    # Blobs are named by their content hash,
+    # so identical state is stored only once in a document.
+    def store(self):
         patch = {}
         data = {}
         @lilv.LV2_State_Store_Function
         def store_hook(_, key, value, size, ty, flags):
             if not (flags & lilv.LV2_STATE_IS_POD):
                 return lilv.LV2_STATE_ERR_BAD_FLAGS
-            dt = ctypes.cast(value, ctypes.POINTER(ctypes.c_char))
-            identifier = len(data)
-            filename = f'{name}.{identifier}.patch'
+            dt = ctypes.cast(value, ctypes.POINTER(ctypes.c_char))[:size]
+            filename = f'patch.{hashlib.sha256(dt).hexdigest()}'
             patch[ self.uri_map[key] ] = {
                 'type': self.uri_map[ty],
                 'path': filename
             }
-            data[filename] = dt[:size]
+            data[filename] = dt
             return lilv.LV2_STATE_SUCCESS
         self.state[0].save(self.instance.get_handle(),
                            store_hook,
@@ -5,6 +5,7 @@ import cairo
 import lv2
 import audio
 import commands
+import journal
 import gui
 import math
 import resolution
@@ -15,13 +16,7 @@ import subprocess
 from fractions import Fraction
 
 def get_tempo_envelope(document):
-    default = random.randint(10, 200)
-    for graph in document.track.graphs:
-        if isinstance(graph, entities.Envelope) and graph.kind == 'tempo':
-            env = resolution.linear_envelope(graph.segments, default)
-            if env.check_positiveness():
-                return env
-    return resolution.LinearEnvelope([ (0, default, 0) ])
+    return resolution.tempo_envelope(document.track.graphs, random.randint(10, 200))
 
 def setup_playback(document):
     bpm = get_tempo_envelope(document)
@@ -99,6 +94,16 @@ def app(editor):
         dialogs = [],
     )
 
+    @gui.listen(e_document_change)
+    def _document_change_():
+        editor.journal.flush(editor.document)
+
+    @gui.listen(gui.e_update)
+    def _update_():
+        status = editor.journal.poll_save(editor.document)
+        if status is not None:
+            this.status = status
+
     @gui.sub
     def upper():
         gui.layout(gui.PaddedLayout(gui.RowLayout(flexible_width=True), 5, 5, 5, 5))
@@ -144,7 +149,8 @@ def app(editor):
                 def _save_down_(x, y, button):
                     document = editor.document
                     document.store_plugins(editor.transport.plugins)
-                    entities.save_document('document.mide.zip', editor.document)
+                    if not editor.journal.save_in_background(document):
+                        this.status = "already saving"
                 gui.hspacing(5)
                 # Editor history
                 history = editor.history
@@ -152,7 +158,7 @@ def app(editor):
                 @undo.listen(gui.e_motion)
                 def _undo_status_(x, y):
                     if len(history.undo_stack) > 0:
-                        this.status = f"undo: {history.undo_stack[-1].name}"
+                        this.status = f"undo: {history.undo_stack[-1].name} ({history.memory_use() // 1024} KiB of history)"
                 @undo.listen(gui.e_button_down)
                 def _undo_down_(x, y, button):
                     if len(history.undo_stack) > 0:
@@ -160,6 +166,7 @@ def app(editor):
                         history.undo()
                         undo.set_dirty()
                         redo.set_dirty()
+                        gui.broadcast(e_document_change)
                 gui.hspacing(5)
                 redo = components.button2(chr(0x21B7), font_size=24, disabled=len(history.redo_stack) == 0, flexible_height = True)
                 @redo.listen(gui.e_motion)
@@ -173,6 +180,7 @@ def app(editor):
                         history.redo()
                         undo.set_dirty()
                         redo.set_dirty()
+                        gui.broadcast(e_document_change)
             gui.vspacing(5)
             @gui.row(height=48)
             def _row_():
@@ -342,8 +350,7 @@ def app(editor):
                                 @clo.listen(gui.e_button_down)
                                 def _clone_(x, y, button):
                                     uid = editor.document.next_uid()
-                                    i = f"instrument.{uid}"
-                                    patch, data = editor.transport.plugins[instrument.uid].store(i)
+                                    patch, data = editor.transport.plugins[instrument.uid].store()
                                     new_instrument = entities.Instrument(instrument.plugin, patch, data, uid)
                                     editor.document.instruments.append(new_instrument)
                                     sdl2.SDL_PauseAudio(1)
@@ -564,6 +571,13 @@ def app(editor):
         def main_panel():
             comp = gui.current_composition.get()
             comp.clipping = True
+            separated = gui.lazybundle(version = resolution.voice_cache.version)
+
+            # Voice separations finish in the background, a new version redraws with them.
+            @gui.listen(gui.e_update)
+            def _update_():
+                separated.version = resolution.voice_cache.version
+
             gui.layout(gui.ScrollableLayout(BeatlineLayout(instrument_colors, document.track), that, flexible_width=True, flexible_height=True))
 
             @gui.pre_drawing
@@ -760,25 +774,15 @@ class BeatlineLayout(gui.ColumnLayout):
         self.events = []
 
         def insert_measured_event(evt, position, duration, obj, graph_uid):
-            beat = float(position)
             layout = self.layouts[graph_uid]
-            start, count = layout.beats_in_this_measure2(beat)
-            remain = count - (position - start)
-            while remain < duration:
-                assert remain > 0
-                self.insert_event(beat, evt, (remain, obj, graph_uid))
-                duration -= remain
-                beat += float(remain)
-                remain = layout.beats_in_this_measure(beat)
-            if duration != 0:
-                self.insert_event(beat, evt, (duration, obj, graph_uid))
+            for beat, length in layout.measures.split(position, duration):
+                self.insert_event(float(beat), evt, (length, obj, graph_uid))
 
         voice_ids = {}
         voice_ys = {}
 
-        k = 0
+        staves = []
         for graph in self.track.graphs:
-            layout = self.layouts[graph.uid]
             if not isinstance(graph, entities.Staff):
                 continue
             vnotes = []
@@ -789,16 +793,20 @@ class BeatlineLayout(gui.ColumnLayout):
                     onset = float(note.position),
                     duration = float(note.duration),
                     pitch = note.pitch.position))
-
-            settings = resolution.VoiceSeparationSettings(
-                max_voices=6,
-                pitch_penalty = 1,
-                gap_penalty = 1,
-                chord_penalty = 1,
-                overlap_penalty = 1,
-                cross_penalty = 1,
-                pitch_lookback = 2)
-            for i, voice in enumerate(resolution.voice_separation(vnotes, settings)):
+            staves.append((graph.uid, vnotes))
+
+        settings = resolution.VoiceSeparationSettings(
+            max_voices=6,
+            pitch_penalty = 1,
+            gap_penalty = 1,
+            chord_penalty = 1,
+            overlap_penalty = 1,
+            cross_penalty = 1,
+            pitch_lookback = 2)
+        k = 0
+        for (graph_uid, vnotes), voices in zip(staves, resolution.voice_separation_async(staves, settings)):
+            layout = self.layouts[graph_uid]
+            for i, voice in enumerate(voices):
                 if not voice:
                     continue
                 offset = 0
@@ -810,32 +818,23 @@ class BeatlineLayout(gui.ColumnLayout):
                     voice_ys[note.uid] = y1
                     if delta > 0:
                         y = (y0 + y1) / 2 if offset > 0 else y1
-                        insert_measured_event(E_REST, offset, delta, y, graph.uid)
+                        insert_measured_event(E_REST, offset, delta, y, graph_uid)
                     offset = note.offset
                     y0 = y1
                 if offset < self.last_beat:
                     delta = self.last_beat - offset
-                    insert_measured_event(E_REST, offset, delta, y0, graph.uid)
+                    insert_measured_event(E_REST, offset, delta, y0, graph_uid)
             k += 6
 
         # Breaking segments into measures
         for voice in self.track.voices:
             graph = self.graphs[voice.staff_uid]
             layout = self.layouts[voice.staff_uid]
-            beat = 0.0
-            remain = layout.beats_in_this_measure(beat)
+            position = Fraction(0)
             for seg in voice.segments:
-                duration = seg.duration
-                while remain < duration:
-                    if remain > 0:
-                        self.insert_event(beat, E_SEGMENT, (remain, seg, graph, voice))
-                        duration -= remain
-                        beat += float(remain)
-                    remain = layout.beats_in_this_measure(beat)
-                if duration != 0: # seg.duration <= remain
-                    self.insert_event(beat, E_SEGMENT, (duration, seg, graph, voice))
-                    remain -= duration
-                    beat += float(duration)
+                for beat, duration in layout.measures.split(position, seg.duration):
+                    self.insert_event(float(beat), E_SEGMENT, (duration, seg, graph, voice))
+                position += seg.duration
 
         for graph in graphics:
             graph.layout.insert_events(self, graph)
@@ -1351,6 +1350,7 @@ class StaffLayout(GraphLayout):
         self.track = track
         self.staff = staff
         self.smeared = smeared = entities.smear(staff.blocks)
+        self.measures = entities.MeasureMap(smeared)
         # beat extent and lowest/highest note
         self.last_beat = 0.0
         lowest = highest = 0
@@ -1386,7 +1386,7 @@ class StaffLayout(GraphLayout):
         self.top_line = self.graph_point(staff.top*12 - 1)
         self.bot_line = self.graph_point(staff.bot*12 + 3)
         # Extend by one measure
-        self.last_beat += self.beats_in_this_measure2(self.last_beat)[1]
+        self.last_beat += float(self.measures.measure(self.last_beat)[1])
 
     def graph_point(self, index):
         return self.reference - (index - self.staff.bot*12)*5
@@ -1399,42 +1399,15 @@ class StaffLayout(GraphLayout):
         for i in range(self.staff.bot, self.staff.top):
             yield self.graph_point(i*12 + 7)
 
-    # Breaking segments into measures
-    def beats_in_this_measure2(self, beat):
-        this, future = entities.at_beat(self.smeared, beat)
-        offset = int(beat) - this.beat
-        pos = this.beat + offset - offset % 4
-        if future is None:
-            return pos, this.beats_in_measure #, False
-        else:
-            distance = future.beat - beat
-            if distance < this.beats_in_measure:
-                return pos, distance #, True
-            else:
-                return pos, this.beats_in_measure #, False
-
-    def beats_in_this_measure(self, beat):
-        this, future = entities.at_beat(self.smeared, beat)
-        if future is None:
-            return this.beats_in_measure #, False
-        else:
-            distance = future.beat - beat
-            if distance < this.beats_in_measure:
-                return distance #, True
-            else:
-                return this.beats_in_measure #, False
-
     def insert_events(self, beatline, graph):
+        for beat in self.measures.barlines(self.last_beat):
+            beatline.insert_event(float(beat), E_BARLINE, graph)
         previous = self.smeared[0]
         for i, smear in enumerate(self.smeared[1:], 1):
-            for stop in resolution.frange(previous.beat + previous.beats_in_measure, smear.beat, previous.beats_in_measure):
-                beatline.insert_event(stop, E_BARLINE, graph)
             block = self.staff.blocks[i]
             unusual = (smear.beat - previous.beat) % previous.beats_in_measure != 0
             beatline.insert_event(block.beat, E_BLOCK, (graph, block, smear, unusual))
             previous = smear
-        for stop in resolution.frange(previous.beat + previous.beats_in_measure, self.last_beat, previous.beats_in_measure, inclusive=True):
-            beatline.insert_event(stop, E_BARLINE, graph)
 
 @gui.composable
 def chord_progression_display(editor, document, track, chord_progression, tool, instrument_uid):
@@ -1653,6 +1626,8 @@ def super_tool_main(editor, document, instrument_uid):
         position = None,
         moving = False,
         moving_beat = 0,
+        moving_count = 0, # Drags done so far, keeps the history entries of drags apart
+        moving_notes = None,
         moving_prev_position = None,
     )
     this = gui.lazybundle(**init)
@@ -1690,11 +1665,15 @@ def super_tool_main(editor, document, instrument_uid):
         this.mouse_x = x
         this.mouse_y = y
         if this.moving:
-            new_beat = (this.mouse_x - this.pressed_x) // 40
-            for note in beatline.layouts[this.graph_uid].staff.notes:
-                if note.uid in this.note_selection:
-                    note.position = max(0, new_beat + this.moving_prev_position[note.uid])
-            this.moving_beat = new_beat
+            new_beat = int((this.mouse_x - this.pressed_x) // 40)
+            if new_beat != this.moving_beat:
+                staff = beatline.layouts[this.graph_uid].staff
+                # Every motion of the same drag goes into one history entry.
+                editor.history.do(commands.shift_notes(staff, this.moving_notes, new_beat, this.moving_prev_position,
+                                                       coalesce=('move', staff.uid, this.moving_count)))
+                this.moving_beat = new_beat
+                # The rest of the editor hears of the change when the drag ends.
+                beatline.graphs[this.graph_uid].set_dirty()
             return
         if this.pressing:
             this.head = int(resolution.sequence_interpolation(x + 20, beatline.offsets, beatline.beats))
@@ -1729,6 +1708,8 @@ def super_tool_main(editor, document, instrument_uid):
         this.pressed_y = y
         if button == 1 and this.moving:
             this.moving = False
+            if this.moving_beat != 0:
+                gui.broadcast(e_document_change)
         elif button == 1 and graph is not None:
             collision = False
             if this.head is not None:
@@ -1739,14 +1720,15 @@ def super_tool_main(editor, document, instrument_uid):
                         if beat == note.position and note.pitch.position == this.position:
                             collision = True
                     if not collision:
-                        graph.layout.staff.notes.append(entities.Note2(
+                        note = entities.Note2(
                             uid = document.next_uid(),
                             position = beat,
                             duration = this.beat1 - this.beat0,
                             pitch = entities.Pitch(this.position, None),
                             timbre = instrument_uid,
-                        ))
-                        this.note_selection.add(graph.layout.staff.notes[-1].uid)
+                        )
+                        editor.history.do(commands.add_notes(graph.layout.staff, [note]))
+                        this.note_selection.add(note.uid)
                         collision = True
             if not collision:
                 this.pressing = True
@@ -1762,30 +1744,25 @@ def super_tool_main(editor, document, instrument_uid):
         elif button == 3 and this.head is not None and graph is not None and this.graph_uid == graph.layout.uid:
             @components.open_context_menu(comp, gx, gy)
             def _context_menu_():
-                def transpose(c): # TODO: check correctness
+                def transpose(c):
                     def _fn_(x, y, button):
-                        for note in graph.layout.staff.notes:
-                            if note.uid in this.note_selection:
-                                note.pitch = entities.Pitch(note.pitch.position+c, note.pitch.accidental)
+                        staff = graph.layout.staff
+                        notes = commands.selected_notes(staff, this.note_selection)
+                        editor.history.do(commands.transpose_notes(staff, notes, c))
                         gui.broadcast(e_document_change)
                     return _fn_
-                def chromatic_transpose(c): # TODO: check correctness
-                    layout = beatline.layouts[this.graph_uid]
+                def chromatic_transpose(c):
                     def _fn_(x, y, button):
-                        for note in graph.layout.staff.notes:
-                            if note.uid in this.note_selection:
-                                key = resolution.canon_key(entities.by_beat(layout.smeared, note.position).canonical_key)
-                                m = resolution.resolve_pitch(note.pitch, key) + c
-                                enh = resolution.enharmonics(m, key)
-                                cost = lambda p: abs(note.pitch.position - p.position) + resolution.pitch_complexity(p)
-                                note.pitch = min(enh, key=cost)
+                        staff = graph.layout.staff
+                        notes = commands.selected_notes(staff, this.note_selection)
+                        editor.history.do(commands.chromatic_transpose_notes(staff, notes, c))
                         gui.broadcast(e_document_change)
                     return _fn_
                 def set_accidental(k):
                     def _fn_(x, y, button):
-                        for note in graph.layout.staff.notes:
-                            if note.uid in this.note_selection:
-                                note.pitch = entities.Pitch(note.pitch.position, k)
+                        staff = graph.layout.staff
+                        notes = commands.selected_notes(staff, this.note_selection)
+                        editor.history.do(commands.set_accidental(staff, notes, k))
                         gui.broadcast(e_document_change)
                     return _fn_
                 menu = gui.current_composition.get()
@@ -1817,75 +1794,52 @@ def super_tool_main(editor, document, instrument_uid):
                 ins = components.button2('instrument', flexible_width=True)
                 @ins.listen(gui.e_button_down)
                 def _ins_down_(x, y, button):
-                    for note in graph.layout.staff.notes:
-                        if note.uid in this.note_selection:
-                            note.timbre = instrument_uid
+                    staff = graph.layout.staff
+                    notes = commands.selected_notes(staff, this.note_selection)
+                    editor.history.do(commands.set_timbre(staff, notes, instrument_uid))
                     gui.broadcast(e_document_change)
                 era = components.button2('erase', flexible_width=True)
                 @era.listen(gui.e_button_down)
                 def _era_down_(x, y, button):
-                    for note in list(graph.layout.staff.notes):
-                        if note.uid in this.note_selection:
-                            graph.layout.staff.notes.remove(note)
+                    staff = graph.layout.staff
+                    notes = commands.selected_notes(staff, this.note_selection)
+                    editor.history.do(commands.erase_notes(staff, notes))
                     this.note_selection = set()
                     gui.inform(components.e_dialog_leave, comp)
                     gui.broadcast(e_document_change)
                 inv = components.button2('invert', flexible_width=True)
                 @inv.listen(gui.e_button_down)
                 def _inv_down_(x, y, button):
-                    pivot = resolution.mean(note.pitch.position
-                                            for note in list(graph.layout.staff.notes)
-                                            if note.uid in this.note_selection)
-                    pivot = round(pivot)
-                    for note in list(graph.layout.staff.notes):
-                        if note.uid in this.note_selection:
-                            pos = (pivot - (note.pitch.position - pivot))
-                            note.pitch = entities.Pitch(pos, note.pitch.accidental)
-                    pivot2 = resolution.mean(note.pitch.position
-                                            for note in list(graph.layout.staff.notes)
-                                            if note.uid in this.note_selection)
-                    pivot2 = round(pivot2)
-                    for note in list(graph.layout.staff.notes):
-                        if note.uid in this.note_selection:
-                            pos = note.pitch.position + (pivot - pivot2)
-                            note.pitch = entities.Pitch(pos, note.pitch.accidental)
+                    staff = graph.layout.staff
+                    notes = commands.selected_notes(staff, this.note_selection)
+                    editor.history.do(commands.invert_notes(staff, notes))
                     gui.broadcast(e_document_change)
 
                 def split_notes(c):
                     def _fn_(x, y, button):
-                        for note in list(graph.layout.staff.notes):
-                            if note.uid in this.note_selection:
-                                note.duration /= c
-                                for i in range(1, c):
-                                    graph.layout.staff.notes.append(entities.Note2(
-                                        uid = document.next_uid(),
-                                        position = note.position + note.duration * i,
-                                        duration = note.duration,
-                                        pitch = note.pitch,
-                                        timbre = note.timbre,
-                                    ))
-                                    this.note_selection.add(graph.layout.staff.notes[-1].uid)
+                        staff = graph.layout.staff
+                        notes = commands.selected_notes(staff, this.note_selection)
+                        delta = commands.split_notes(staff, notes, c, document.next_uid)
+                        editor.history.do(delta)
+                        this.note_selection.update(note.uid for note in delta.added)
                         gui.broadcast(e_document_change)
                     return _fn_
                 def mul_notes(c):
                     def _fn_(x, y, button):
-                        for note in list(graph.layout.staff.notes):
-                            if note.uid in this.note_selection:
-                                note.duration *= c
-                                note.position = (note.position - this.beat0) * c + this.beat0
+                        staff = graph.layout.staff
+                        notes = commands.selected_notes(staff, this.note_selection)
+                        editor.history.do(commands.scale_notes(staff, notes, c, this.beat0))
                         gui.broadcast(e_document_change)
                     return _fn_
                 m = components.button2("move", flexible_width=True)
                 @m.listen(gui.e_button_down)
                 def _move_down_(gx, gy, button):
                     this.moving = True
+                    this.moving_count += 1
                     this.moving_beat = 0
-                    this.moving_prev_position = dict()
+                    this.moving_notes = commands.selected_notes(graph.layout.staff, this.note_selection)
+                    this.moving_prev_position = [note.position for note in this.moving_notes]
                     this.pressed_x, this.pressed_y = comp.local_point(gx, gy)
-                    for note in list(graph.layout.staff.notes):
-                        if note.uid in this.note_selection:
-                            this.moving_prev_position[note.uid] = note.position
-                 
 
         #                    layout = beatline.layouts[this.graph_uid]
         #                    this.moving = True
@@ -1911,10 +1865,9 @@ def super_tool_main(editor, document, instrument_uid):
                 @chord.listen(gui.e_button_down)
                 def _chord_down_(x, y, button):
                     layout = beatline.layouts[this.graph_uid]
-                    for note in list(graph.layout.staff.notes):
-                        if note.uid in this.note_selection:
-                            note.position = this.beat0
-                            note.duration = this.beat1 - this.beat0
+                    staff = graph.layout.staff
+                    notes = commands.selected_notes(staff, this.note_selection)
+                    editor.history.do(commands.chord_notes(staff, notes, this.beat0, this.beat1))
                     # TODO: "reflow" the notes.
         #                    beat = 0
         #                    duration = 0
@@ -1964,11 +1917,9 @@ def super_tool_main(editor, document, instrument_uid):
                 retro = components.button2("retrograde", flexible_width=True)
                 @retro.listen(gui.e_button_down)
                 def _retro_down(x, y, button):
-                    b0 = this.beat0
-                    b1 = this.beat1
-                    for note in list(graph.layout.staff.notes):
-                        if note.uid in this.note_selection:
-                            note.position = b1 - (note.position - b0) - note.duration
+                    staff = graph.layout.staff
+                    notes = commands.selected_notes(staff, this.note_selection)
+                    editor.history.do(commands.retrograde_notes(staff, notes, this.beat0, this.beat1))
                     gui.broadcast(e_document_change)
         gui.broadcast(e_document_change)
 
@@ -3089,7 +3040,8 @@ def staff_block(ctx, layout, x0, y0, block, smear):
 class Editor:
     def __init__(self):
         block_length = 1024*2
-        self.document = entities.load_document('document.mide.zip')
+        self.journal = journal.Journal('document.mide.zip')
+        self.document = self.journal.load()
         self.history = commands.History(self.document)
         self.history.do(commands.DemoCommand())
         self.pluginhost = lv2.PluginHost()
@@ -3174,6 +3126,10 @@ class Editor:
                                 self.widgets.pop(widget.uid)
 
         sdl2.SDL_StopTextInput()
+        resolution.shutdown_separation()
+        # Not every edit broadcasts e_document_change.
+        self.journal.flush(self.document)
+        self.journal.close()
         self.pluginhost.close()
         sdl2.ext.quit()
 
@@ -0,0 +1,412 @@
+"""
+    Standard MIDI File import and export
+    Beats are taken to be quarter notes, the same unit the tempo envelope is in.
+"""
+from fractions import Fraction
+from array import array
+import entities
+import resolution
+import bisect
+import os
+import struct
+import sys
+import tempfile
+
+DEFAULT_TEMPO = 500000 # microseconds per quarter note, 120 bpm
+
+def read_varint(data, i):
+    value = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, i
+
+# Chunks are read one at a time, so only one track is in memory at once.
+def read_chunks(fd):
+    while True:
+        header = fd.read(8)
+        if len(header) < 8:
+            return
+        kind, length = struct.unpack('>4sI', header)
+        data = fd.read(length)
+        if len(data) < length:
+            raise ValueError("truncated chunk")
+        yield kind, data
+
+# Yields (tick, status, a, b) for channel messages
+# and (tick, 0xFF, type, payload) for meta events, system exclusive is skipped.
+def read_track(data):
+    tick = 0
+    running = 0
+    i = 0
+    n = len(data)
+    while i < n:
+        delta = 0
+        while True:
+            byte = data[i]
+            i += 1
+            delta = (delta << 7) | (byte & 0x7f)
+            if byte < 0x80:
+                break
+        tick += delta
+        status = data[i]
+        if status < 0x80:
+            if running == 0:
+                raise ValueError("running status without a status byte")
+            status = running
+        else:
+            i += 1
+        if status < 0xf0:
+            running = status
+            if 0xc0 <= status < 0xe0:
+                yield tick, status, data[i], 0
+                i += 1
+            else:
+                yield tick, status, data[i], data[i+1]
+                i += 2
+        elif status == 0xff:
+            kind = data[i]
+            length, i = read_varint(data, i + 1)
+            yield tick, status, kind, data[i:i+length]
+            i += length
+        elif status == 0xf0 or status == 0xf7:
+            length, i = read_varint(data, i)
+            i += length
+        else:
+            raise ValueError(f"unexpected status byte {status:#x}")
+
+# Spells every MIDI key in a key signature,
+# notes in the key get no accidental and the rest follow the direction of the key.
+def pitch_table(canonical_key):
+    key = resolution.canon_key(canonical_key)
+    base = resolution.base_key
+    direction = -1 if canonical_key < 0 else +1
+    table = []
+    for m in range(128):
+        pc = m % 12
+        for d in range(7):
+            if key[d] % 12 == pc:
+                table.append(entities.Pitch((m - key[d]) // 12 * 7 - 7 + d))
+                break
+        else:
+            for accidental in [0, direction]:
+                if (pc - accidental) % 12 in base:
+                    d = base.index((pc - accidental) % 12)
+                    table.append(entities.Pitch((m - base[d] - accidental) // 12 * 7 - 7 + d, accidental))
+                    break
+    return table
+
+def time_signature(data):
+    numerator, power = data[0], data[1]
+    if power == 2:
+        return numerator, 4
+    beats = Fraction(numerator * 4, 2**power)
+    if beats.denominator == 1:
+        return int(beats), 4
+    return None
+
+def key_signature(data):
+    sharps = struct.unpack('b', data[:1])[0]
+    return max(-7, min(7, sharps)), ('minor' if data[1] else 'major')
+
+# Reads a file into staves, one per track (one per channel in a format 0 file),
+# and a tempo envelope if the file has tempo changes.
+# timbres maps channels 0-15 to instrument uids.
+def import_smf(filename, next_uid, timbres=None):
+    timbres = timbres or {}
+    columns = {} # group -> (start ticks, end ticks, keys, channels)
+    tempos = {}
+    signatures = {}
+    keys = {}
+    last_tick = 0
+    def add_note(group, start, end, key, channel):
+        if group not in columns:
+            columns[group] = (array('q'), array('q'), array('B'), array('B'))
+        starts, ends, notes, channels = columns[group]
+        starts.append(start)
+        ends.append(end)
+        notes.append(key)
+        channels.append(channel)
+    with open(filename, 'rb') as fd:
+        chunks = read_chunks(fd)
+        for kind, data in chunks:
+            if kind == b'MThd':
+                break
+        else:
+            raise ValueError("not a standard MIDI file")
+        smf_format, _, division = struct.unpack('>HHH', data[:6])
+        if division & 0x8000:
+            raise ValueError("SMPTE time division is not supported")
+        track_index = 0
+        for kind, data in chunks:
+            if kind != b'MTrk':
+                continue
+            pending = {} # (channel, key) -> stack of start ticks
+            tick = 0
+            for tick, status, a, b in read_track(data):
+                if status == 0xff:
+                    if a == 0x51 and len(b) == 3:
+                        tempos[tick] = int.from_bytes(b, 'big')
+                    elif a == 0x58 and len(b) >= 2:
+                        signatures[tick] = time_signature(b)
+                    elif a == 0x59 and len(b) == 2:
+                        keys[tick] = key_signature(b)
+                    continue
+                kind = status & 0xf0
+                channel = status & 0x0f
+                if kind == 0x90 and b > 0:
+                    pending.setdefault((channel, a), []).append(tick)
+                elif kind == 0x80 or kind == 0x90:
+                    stack = pending.get((channel, a))
+                    if stack:
+                        start = stack.pop()
+                        if tick > start:
+                            add_note((track_index, channel if smf_format == 0 else 0), start, tick, a, channel)
+                last_tick = max(last_tick, tick)
+            # Notes still held at the end of a track last until its end.
+            for (channel, a), stack in pending.items():
+                for start in stack:
+                    if tick > start:
+                        add_note((track_index, channel if smf_format == 0 else 0), start, tick, a, channel)
+            track_index += 1
+
+    key_ticks = sorted(keys)
+    tables = {}
+    def table_at(tick):
+        i = bisect.bisect_right(key_ticks, tick) - 1
+        canonical_key = keys[key_ticks[i]][0] if i >= 0 else 0
+        if canonical_key not in tables:
+            tables[canonical_key] = pitch_table(canonical_key)
+        return tables[canonical_key]
+
+    def beat(tick):
+        return Fraction(tick, division)
+
+    graphs = []
+    for group in sorted(columns):
+        starts, ends, notes, channels = columns[group]
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        durations = {}
+        staff_notes = []
+        for i in order:
+            start = starts[i]
+            length = ends[i] - start
+            duration = durations.get(length)
+            if duration is None:
+                duration = durations[length] = Fraction(length, division)
+            staff_notes.append(entities.Note2(
+                uid = next_uid(),
+                position = Fraction(start, division),
+                duration = duration,
+                pitch = table_at(start)[notes[i]],
+                timbre = timbres.get(channels[i]),
+            ))
+        columns[group] = None
+        graphs.append(entities.Staff(next_uid(), 3, 2, staff_blocks(signatures, keys, beat), staff_notes))
+
+    if tempos:
+        graphs.append(tempo_envelope(next_uid(), tempos, beat, last_tick))
+    return graphs
+
+def staff_blocks(signatures, keys, beat):
+    changes = {}
+    for tick, signature in signatures.items():
+        if signature is not None:
+            changes.setdefault(tick, {}).update(beats_in_measure=signature[0], beat_unit=signature[1])
+    for tick, (canonical_key, mode) in keys.items():
+        changes.setdefault(tick, {}).update(canonical_key=canonical_key, mode=mode)
+    first = dict(beats_in_measure=4, beat_unit=4, canonical_key=0, clef=3, mode=None)
+    first.update(changes.pop(0, {}))
+    blocks = [entities.StaffBlock(beat=0, **first)]
+    for tick in sorted(changes):
+        blocks.append(entities.StaffBlock(beat=beat(tick), **changes[tick]))
+    return blocks
+
+def tempo_envelope(uid, tempos, beat, last_tick):
+    if 0 not in tempos:
+        tempos[0] = DEFAULT_TEMPO
+    ticks = sorted(tempos)
+    segments = []
+    for i, tick in enumerate(ticks):
+        stop = ticks[i+1] if i+1 < len(ticks) else max(last_tick, tick + 1)
+        segments.append(entities.EnvelopeSegment(
+            control = 0,
+            value = 60000000 / tempos[tick],
+            duration = beat(stop) - beat(tick)))
+    return entities.Envelope(uid, 'tempo', segments)
+
+# Notes are written at full velocity, dynamics envelopes are not exported.
+# Staves have no dynamics envelope of their own: the transport scales staff notes
+# by 127 * dyn.value(beat) with an envelope it looks up under no uid, which falls
+# back to 1.0, so both agree until staves get one.
+VELOCITY = 127
+# Tempo ramps are written as a tempo change every quarter of a beat.
+RAMP_STEPS = 4
+# Channels given to instruments in order, channel 10 is left for drums.
+CHANNELS = [c for c in range(16) if c != 9]
+
+def to_tick(numerator, denominator, division):
+    return (2 * numerator * division + denominator) // (2 * denominator)
+
+def varint(value):
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(data))
+
+# Writes one MTrk chunk from pieces of encoded events,
+# the chunk length is patched in once the events have been written out.
+def write_track(fd, pieces):
+    fd.write(b'MTrk\0\0\0\0')
+    start = fd.tell()
+    for data in pieces:
+        fd.write(data)
+    fd.write(b'\x00\xff\x2f\x00')
+    stop = fd.tell()
+    fd.seek(start - 4)
+    fd.write(struct.pack('>I', stop - start))
+    fd.seek(stop)
+
+# Encodes (tick, message) pairs given in tick order.
+def messages(events):
+    data = bytearray()
+    last = 0
+    for tick, message in events:
+        data += varint(tick - last)
+        data += message
+        last = tick
+    yield data
+
+# Note events are packed into integers as (tick, on, key), so that sorting them
+# puts note-offs before note-ons at the same tick.
+def note_messages(packed, channel, piece_size=1 << 16):
+    data = bytearray()
+    status = bytes([0x90 | channel])
+    last = 0
+    for event in packed:
+        tick = event >> 8
+        delta = tick - last
+        last = tick
+        if delta < 0x80:
+            data.append(delta)
+        else:
+            data += varint(delta)
+        # Note-on with zero velocity ends a note, so running status covers every event.
+        if status:
+            data += status
+            status = None
+        data.append(event & 0x7f)
+        data.append(VELOCITY if event & 0x80 else 0)
+        if len(data) >= piece_size:
+            yield data
+            data = bytearray()
+    yield data
+
+def conductor_events(document, tempo, division, end):
+    events = []
+    for graph in document.track.graphs:
+        if isinstance(graph, entities.Staff):
+            previous = None
+            for block in entities.smear(graph.blocks):
+                beat = Fraction(block.beat)
+                tick = to_tick(beat.numerator, beat.denominator, division)
+                if previous is None or block.beats_in_measure != previous.beats_in_measure:
+                    events.append((tick, bytes([0xff, 0x58, 4, block.beats_in_measure, 2, 24, 8])))
+                if previous is None or (block.canonical_key, block.mode) != (previous.canonical_key, previous.mode):
+                    events.append((tick, bytes([0xff, 0x59, 2, block.canonical_key & 0xff, block.mode == 'minor'])))
+                previous = block
+            break
+    for i, (p, c, k) in enumerate(tempo.vector):
+        tick = round(p * division)
+        if k == 0:
+            stop = tick + 1
+        elif i + 1 < len(tempo.vector):
+            stop = round(tempo.vector[i+1][0] * division)
+        else:
+            stop = max(tick + 1, end)
+        for t in range(tick, stop, division // RAMP_STEPS):
+            bpm = c + k * (t / division - p)
+            events.append((t, b'\xff\x51\x03' + round(60000000 / bpm).to_bytes(3, 'big')))
+    events.sort(key=lambda event: event[0])
+    return events
+
+# Writes a format 1 file with a conductor track for the tempo map and
+# the signatures of the first staff, followed by one track per instrument.
+def export_smf(filename, document, division=960, default_bpm=120):
+    graphs = document.track.graphs
+    tempo = resolution.tempo_envelope(graphs, default_bpm)
+    tracks = {}
+    end = 0
+    for graph in graphs:
+        if not isinstance(graph, entities.Staff):
+            continue
+        smeared = entities.smear(graph.blocks)
+        beats = [block.beat for block in smeared]
+        keys = [resolution.canon_key(block.canonical_key) for block in smeared]
+        for note in graph.notes:
+            if note.timbre is None:
+                continue
+            position = note.position
+            key = keys[bisect.bisect_right(beats, position) - 1]
+            m = resolution.resolve_pitch(note.pitch, key)
+            if not 0 <= m < 128:
+                continue
+            duration = note.duration
+            numerator = position.numerator * duration.denominator + duration.numerator * position.denominator
+            denominator = position.denominator * duration.denominator
+            t0 = to_tick(position.numerator, position.denominator, division)
+            t1 = max(t0 + 1, to_tick(numerator, denominator, division))
+            if note.timbre not in tracks:
+                tracks[note.timbre] = array('q')
+            packed = tracks[note.timbre]
+            packed.append(t0 << 8 | 0x80 | m)
+            packed.append(t1 << 8 | m)
+            end = max(end, t1)
+    with open(filename, 'wb') as fd:
+        fd.write(b'MThd' + struct.pack('>IHHH', 6, 1, 1 + len(tracks), division))
+        write_track(fd, messages(conductor_events(document, tempo, division, end)))
+        for i, timbre in enumerate(sorted(tracks)):
+            write_track(fd, note_messages(sorted(tracks.pop(timbre)), CHANNELS[i % len(CHANNELS)]))
+
+# Imports a file, saves a snapshot of it in both track formats and loads it back.
+# Returns the steps (snapshot or a format) where the track differs from the imported one.
+def roundtrip(filename):
+    track = entities.Track(import_smf(filename, entities.UidGenerator(1000)), [])
+    failed = []
+    # Saving goes through a snapshot, as in the editor.
+    snapshot = entities.Document(track, [], entities.UidGenerator(0)).snapshot()
+    if snapshot.snapshot().track.content_hash() != track.content_hash():
+        failed.append('snapshot')
+    with tempfile.TemporaryDirectory() as directory:
+        for track_format in ('json', 'binary'):
+            path = os.path.join(directory, f"{track_format}.mide.zip")
+            entities.save_document(path, snapshot, track_format)
+            loaded = entities.load_document(path).track
+            if loaded.content_hash() != track.content_hash():
+                failed.append(track_format)
+    return failed
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'check':
+        failed = roundtrip(sys.argv[2])
+        if failed:
+            sys.exit(f"track changed in the {' and '.join(failed)} round trip")
+        print("ok")
+    elif len(sys.argv) == 4 and sys.argv[1] == 'import':
+        next_uid = entities.UidGenerator(1000)
+        document = entities.Document(
+            track = entities.Track(import_smf(sys.argv[2], next_uid), []),
+            instruments = [],
+            next_uid = next_uid,
+        )
+        entities.save_document(sys.argv[3], document, 'binary')
+    elif len(sys.argv) == 4 and sys.argv[1] == 'export':
+        export_smf(sys.argv[3], entities.load_document(sys.argv[2]))
+    else:
+        sys.exit("usage: midi.py import song.mid document.mide.zip\n"
+                 "       midi.py export document.mide.zip song.mid\n"
+                 "       midi.py check song.mid")
@@ -6,8 +6,13 @@ import math
 import random
 from itertools import groupby, islice
 from operator import attrgetter
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import ctypes
+import concurrent.futures
+import hashlib
+import os
+import threading
+import traceback
 import numpy as np
 
 char_accidental = {
@@ -245,6 +250,15 @@ def linear_envelope(segments, default):
         current_position += float(duration)
     return LinearEnvelope(envelope)
 
+# The tempo map used by playback and export, in beats per minute.
+def tempo_envelope(graphs, default):
+    for graph in graphs:
+        if isinstance(graph, entities.Envelope) and graph.kind == 'tempo':
+            env = linear_envelope(graph.segments, default)
+            if env.check_positiveness():
+                return env
+    return LinearEnvelope([ (0, default, 0) ])
+
 class LinearEnvelope:
     def __init__(self, vector):
         self.vector = vector # vector consists of list of triples:
@@ -528,7 +542,12 @@ VoiceSeparationSettings = namedtuple('VoiceSeparationSettings', [
     'overlap_penalty',
     'cross_penalty',
     'pitch_lookback',
-])
+    # Searches per slice in the C version, the cheapest is kept. They run on up to
+    # one thread per core, so past the core count each one adds a full search to
+    # the wall time, and on a single core n restarts take about n times as long.
+    'restarts',
+    'seed',     # Base seed of the C search, the same seed always gives the same voices
+], defaults=[1, 0])
 
 class Note:
     def __init__(self, uid, onset, duration, pitch):
@@ -548,23 +567,24 @@ class Note:
 
 Chord = namedtuple('Chord', ['prev', 'this'])
 
-def voice_separation(notes, settings):
+# The search in voice_separation.c written out in Python, kept as the
+# reference benchmark_voices.py measures the C version against.
+# It draws from the global random generator.
+def voice_separation_reference(notes, settings):
     notes.sort(key=lambda x: x.onset)
     def segment_notes(notes):
+        # A note overlaps every note of the slice when it starts before the earliest offset
         current_slice = []
+        min_offset = None
         for note in notes:
-            if not current_slice:
-                # Start a new slice if the current slice is empty
+            if current_slice and note.onset < min_offset:
                 current_slice.append(note)
+                min_offset = min(min_offset, note.offset)
             else:
-                # Check if the note overlaps with all notes in the current slice
-                if all(note.overlaps(n) for n in current_slice):
-                    current_slice.append(note)
-                else:
-                    # If it doesn't overlap with all, finalize the current slice and start a new one
+                if current_slice:
                     yield current_slice
-                    current_slice = [note]
-        # Append the last slice
+                current_slice = [note]
+                min_offset = note.offset
         if current_slice:
             yield current_slice
 
@@ -785,7 +805,7 @@ def voice_separation(notes, settings):
 #     Note(None, 4, 1, 67)   # G4
 # ]
 # 
-# voices = voice_separation(notes, settings)
+# voices = voice_separation_reference(notes, settings)
 # for i, voice in enumerate(voices):
 #     print(f'voice {i}')
 #     for note in voice:
@@ -812,40 +832,336 @@ class Descriptor(ctypes.Structure):
         ('cross_penalty', ctypes.c_double),
         ('pitch_lookback', ctypes.c_int),
         ('lcg', ctypes.c_uint),
+        ('slice', ctypes.POINTER(ctypes.c_int)),
+        ('restarts', ctypes.c_int),
+        ('threads', ctypes.c_int),
+        ('time_budget', ctypes.c_double),
+        ('iteration_budget', ctypes.c_longlong),
+        ('exhausted', ctypes.c_int),
+        ('cancel', ctypes.POINTER(ctypes.c_int)),
+        ('stats', ctypes.c_void_p),
     ]
 
-def voice_separation(notes, settings):
+lib.voice_separation_resume.restype = ctypes.c_int
+lib.voice_separation_cost.restype = ctypes.c_double
+
+COST_PARTS = ['pitch', 'gap', 'chord', 'overlap', 'cross']
+
+# Laid out like SliceStats in voice_separation.c.
+SLICE_STATS = np.dtype(
+    [('start', np.int32), ('notes', np.int32), ('cost', np.float64)]
+  + [(part, np.float64) for part in COST_PARTS]
+  + [('iterations', np.int64), ('improvements', np.int32)], align=True)
+
+def as_pointer(array, ctype):
+    return array.ctypes.data_as(ctypes.POINTER(ctype))
+
+# Start indices of the slices voice separation solves one at a time,
+# runs of notes sorted by onset that all sound together.
+def note_slices(onset, duration):
+    onset = np.ascontiguousarray(onset, dtype=np.float64)
+    offset = onset + np.asarray(duration, dtype=np.float64)
+    starts = np.zeros(len(onset), dtype=np.int32)
+    count = lib.note_slices(len(onset), as_pointer(onset, ctypes.c_double), as_pointer(offset, ctypes.c_double), as_pointer(starts, ctypes.c_int))
+    return starts[:count]
+
+# Solved voice separation of one staff, kept so the next edit can resume from it.
+# With stats, the search of each slice is recorded, see stats().
+class Separation:
+    def __init__(self, onset, duration, position, settings, stats=False):
+        self.onset = onset
+        self.duration = duration
+        self.position = position
+        self.settings = settings
+        self.voice = np.zeros(len(onset), dtype=np.int32) - 1
+        self.link = np.zeros(len(onset), dtype=np.int32) - 1
+        self.slice = np.zeros(len(onset), dtype=np.int32)
+        self.slice_stats = np.zeros(len(onset), dtype=SLICE_STATS) if stats else None # At the first note of each slice
+        self.solved = 0 # Notes searched by the last solve
+        self.exhausted = False # Budget ran out, the later slices are only settled greedily
+
+    def descriptor(self, offset=None):
+        settings = self.settings
+        return Descriptor(
+            max_notes=len(self.onset),
+            onset=as_pointer(self.onset, ctypes.c_double),
+            duration=as_pointer(self.duration, ctypes.c_double),
+            position=as_pointer(self.position, ctypes.c_int),
+            offset=None if offset is None else as_pointer(offset, ctypes.c_double),
+            voice=as_pointer(self.voice, ctypes.c_int),
+            link=as_pointer(self.link, ctypes.c_int),
+            max_voices=settings.max_voices,
+            pitch_penalty=settings.pitch_penalty,
+            gap_penalty=settings.gap_penalty,
+            chord_penalty=settings.chord_penalty,
+            overlap_penalty=settings.overlap_penalty,
+            cross_penalty=settings.cross_penalty,
+            pitch_lookback=settings.pitch_lookback,
+            lcg=settings.seed,
+            slice=as_pointer(self.slice, ctypes.c_int),
+            restarts=settings.restarts,
+            threads=min(settings.restarts, os.cpu_count() or 1),
+            stats=None if self.slice_stats is None else self.slice_stats.ctypes.data,
+        )
+
+    # Weighted cost of the current voices summed over the slices, and its parts by COST_PARTS.
+    def cost(self):
+        parts = (ctypes.c_double * len(COST_PARTS))()
+        offset = self.onset + self.duration
+        link = np.zeros(len(self.onset), dtype=np.int32)
+        desc = self.descriptor(offset)
+        desc.link = as_pointer(link, ctypes.c_int)
+        total = lib.voice_separation_cost(ctypes.byref(desc), parts)
+        return total, dict(zip(COST_PARTS, parts))
+
+    # Record array with a row for each slice: its first note, size, final cost and
+    # its parts, search steps summed over the restarts, and improvements found.
+    # Slices kept from a previous separation keep its rows.
+    def stats(self):
+        if self.slice_stats is None:
+            raise ValueError("separation was made without stats")
+        return self.slice_stats[np.flatnonzero(self.slice)].view(np.recarray)
+
+    # Slices that end before the first changed note are kept from previous.
+    def resume_point(self, previous):
+        n = min(len(self.onset), len(previous.onset))
+        differ = ((self.onset[:n] != previous.onset[:n])
+                | (self.duration[:n] != previous.duration[:n])
+                | (self.position[:n] != previous.position[:n]))
+        first = int(np.argmax(differ)) if differ.any() else n
+        starts = np.flatnonzero(previous.slice[:first])
+        return int(starts[-1]) if len(starts) else 0
+
+    # Budgets bound the whole solve, None for no limit.
+    # Setting cancel[0] from another thread stops the solve early, the result is then unusable.
+    def solve(self, previous=None, time_budget=None, iteration_budget=None, cancel=None):
+        offset = self.onset + self.duration
+        desc = self.descriptor(offset)
+        desc.time_budget = time_budget or 0
+        desc.iteration_budget = iteration_budget or 0
+        if cancel is not None:
+            desc.cancel = as_pointer(cancel, ctypes.c_int)
+        if (previous is None or tuple(previous.settings) != tuple(self.settings)
+            or (self.slice_stats is not None and previous.slice_stats is None)):
+            lib.voice_separation(ctypes.byref(desc))
+            self.solved = len(self.onset)
+        else:
+            resume = self.resume_point(previous)
+            for column in ('voice', 'link', 'slice', 'slice_stats'):
+                if getattr(self, column) is not None:
+                    getattr(self, column)[:resume] = getattr(previous, column)[:resume]
+            stop = lib.voice_separation_resume(ctypes.byref(desc), ctypes.byref(previous.descriptor()), resume)
+            self.solved = stop - resume
+        self.exhausted = bool(desc.exhausted)
+        for column in (self.onset, self.duration, self.position, self.voice, self.link, self.slice, self.slice_stats):
+            if column is not None:
+                column.flags.writeable = False
+        return self
+
+# Separations of recently seen staves, keyed by the settings and
+# a digest of the (onset, duration, pitch) columns in onset order.
+# The latest complete separation of each staff is kept as well, for resuming after an edit.
+# The search is seeded the same way every time, so a hit is what a fresh run would give.
+# Separations cut short by a budget are replaced once improved in the background,
+# version counts those and the separations finished in the background.
+class VoiceSeparationCache:
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = OrderedDict()
+        self.staves = OrderedDict()
+        self.improving = set()
+        self.pending = {} # staff uid -> (key, future, cancel flag), for voice_separation_async
+        self.failed = {}  # staff uid -> (key, exception) of the last solve that raised
+        self.shown = {}   # staff uid -> (separation, voice by note uid)
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            separation = self.entries.get(key)
+            if separation is not None:
+                self.entries.move_to_end(key)
+            return separation
+
+    def put(self, key, separation):
+        with self.lock:
+            self.entries[key] = separation
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def latest(self, staff_uid):
+        with self.lock:
+            return self.staves.get(staff_uid)
+
+    def set_latest(self, staff_uid, separation):
+        with self.lock:
+            self.staves[staff_uid] = separation
+            self.staves.move_to_end(staff_uid)
+            while len(self.staves) > self.size:
+                self.staves.popitem(last=False)
+
+    # An edit made meanwhile may have moved on from previous, its latest is kept then.
+    def publish(self, key, staff_uid, previous, separation):
+        with self.lock:
+            self.improving.discard(key)
+            if key in self.entries:
+                self.entries[key] = separation
+            if staff_uid is not None and self.staves.get(staff_uid) is previous:
+                self.staves[staff_uid] = separation
+            self.version += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.staves.clear()
+            self.shown.clear()
+            self.failed.clear()
+
+voice_cache = VoiceSeparationCache()
+background = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1)
+
+def improve_in_background(cache, key, staff_uid, separation):
+    with cache.lock:
+        if key in cache.improving:
+            return
+        cache.improving.add(key)
+        previous = cache.staves.get(staff_uid)
+    def improve():
+        try:
+            better = Separation(separation.onset, separation.duration, separation.position, separation.settings)
+            better.solve(previous)
+        except:
+            with cache.lock:
+                cache.improving.discard(key)
+            raise
+        cache.publish(key, staff_uid, previous, better)
+    background.submit(improve)
+
+# With staff_uid given, an edited staff is re-solved from the first slice
+# the edit touches, until the result converges back to the previous one.
+def voice_separation(notes, settings, cache=voice_cache, staff_uid=None):
+    return voice_separation_batch([(staff_uid, notes)], settings, cache)[0]
+
+# Separates staves given as (staff_uid, notes) pairs, staves that miss the cache
+# are solved on a thread pool. Each has its own descriptor and random state,
+# and ctypes drops the GIL for the call, so the searches run in parallel.
+# With a budget the searches return their best so far once it is spent, and
+# unless improve is false the cut short staves are solved again in the background.
+def voice_separation_batch(staves, settings, cache=voice_cache, workers=None,
+                           time_budget=None, iteration_budget=None, improve=True):
+    separations = []
+    jobs = []
+    for staff_uid, notes in staves:
+        onset, duration, position, key = note_columns(notes, settings)
+        separation = None
+        if cache is not None:
+            separation = cache.get(key)
+        if separation is None:
+            separation = Separation(onset, duration, position, settings)
+            previous = None
+            if cache is not None and staff_uid is not None:
+                previous = cache.latest(staff_uid)
+            jobs.append((separation, previous))
+        separations.append((separation, key))
+    if len(jobs) > 1 and workers != 1:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda job: job[0].solve(job[1], time_budget, iteration_budget), jobs))
+    else:
+        for separation, previous in jobs:
+            separation.solve(previous, time_budget, iteration_budget)
+    results = []
+    for (staff_uid, notes), (separation, key) in zip(staves, separations):
+        if cache is not None:
+            cache.put(key, separation)
+            if staff_uid is not None and not separation.exhausted:
+                cache.set_latest(staff_uid, separation)
+            if separation.exhausted and improve:
+                improve_in_background(cache, key, staff_uid, separation)
+        results.append(group_voices(notes, separation.voice.tolist(), settings))
+    return results
+
+# Sorts the notes and returns their columns with the cache key for them.
+def note_columns(notes, settings):
     notes.sort(key=attrgetter('onset'))
-    max_notes = len(notes)
     onset = np.array([n.onset for n in notes], dtype=np.float64)
     duration = np.array([n.duration for n in notes], dtype=np.float64)
-    offset = np.array([n.offset for n in notes], dtype=np.float64)
-    voice = np.zeros(max_notes, dtype=np.int32) - 1
-    link = np.zeros(max_notes, dtype=np.int32) - 1
     position = np.array([n.pitch for n in notes], dtype=np.int32)
-    desc = Descriptor(
-        max_notes=max_notes,
-        onset=onset.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        duration=duration.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        position=position.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
-        offset=offset.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        voice=voice.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
-        link=link.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
-        max_voices=settings.max_voices,
-        pitch_penalty=settings.pitch_penalty,
-        gap_penalty=settings.gap_penalty,
-        chord_penalty=settings.chord_penalty,
-        overlap_penalty=settings.overlap_penalty,
-        cross_penalty=settings.cross_penalty,
-        pitch_lookback=settings.pitch_lookback,
-        lcg = 0,
-    )
-    lib.voice_separation(ctypes.byref(desc))
-    voices = []
-    for i in range(desc.max_voices):
-        voice = []
-        for k in range(desc.max_notes):
-            if desc.voice[k] == i:
-                voice.append(notes[k])
-        voices.append(voice)
+    digest = hashlib.blake2b(digest_size=16)
+    for column in (onset, duration, position):
+        digest.update(column.tobytes())
+    return onset, duration, position, (tuple(settings), digest.digest())
+
+def group_voices(notes, voice, settings):
+    voices = [[] for _ in range(settings.max_voices)]
+    for note, i in zip(notes, voice):
+        if 0 <= i < settings.max_voices:
+            voices[i].append(note)
     return voices
+
+# Like voice_separation_batch, but staves missing from the cache are solved
+# on the background threads and never waited for. Meanwhile their notes
+# keep the voices they were last shown with, new notes go in the first voice.
+# A newer edit of a staff cancels its separation still in progress.
+# cache.version changes when a separation finishes, time to measure again.
+def voice_separation_async(staves, settings, cache=voice_cache):
+    results = []
+    for staff_uid, notes in staves:
+        onset, duration, position, key = note_columns(notes, settings)
+        separation = cache.get(key)
+        if separation is not None:
+            shown = cache.shown.get(staff_uid)
+            if shown is None or shown[0] is not separation:
+                cache.shown[staff_uid] = (separation,
+                    dict(zip((note.uid for note in notes), separation.voice.tolist())))
+            results.append(group_voices(notes, separation.voice.tolist(), settings))
+            continue
+        with cache.lock:
+            pending = cache.pending.get(staff_uid)
+            failed = cache.failed.get(staff_uid, (None,))[0] == key
+        # A solve that raised is not retried until the notes or the settings change.
+        if not failed and (pending is None or pending[0] != key):
+            if pending is not None:
+                pending[1].cancel()
+                pending[2][0] = 1
+            submit_separation(cache, staff_uid, key, Separation(onset, duration, position, settings))
+        shown = cache.shown.get(staff_uid)
+        voice_of = shown[1] if shown is not None else {}
+        results.append(group_voices(notes, [voice_of.get(note.uid, 0) for note in notes], settings))
+    return results
+
+def submit_separation(cache, staff_uid, key, separation):
+    cancel = np.zeros(1, dtype=np.int32)
+    previous = cache.latest(staff_uid)
+    def solve():
+        try:
+            separation.solve(previous, cancel=cancel)
+            if cancel[0]:
+                return
+            cache.put(key, separation)
+            cache.set_latest(staff_uid, separation)
+            with cache.lock:
+                cache.failed.pop(staff_uid, None)
+                cache.version += 1
+        except Exception as error:
+            traceback.print_exc()
+            with cache.lock:
+                cache.failed[staff_uid] = (key, error)
+            raise
+        finally:
+            with cache.lock:
+                # Only this submission's entry, a newer one for the same notes may have replaced it.
+                if cache.pending.get(staff_uid, (None, None, None))[2] is cancel:
+                    cache.pending.pop(staff_uid)
+    with cache.lock:
+        cache.pending[staff_uid] = (key, background.submit(solve), cancel)
+
+# On exit, cancels the separations still queued or running and waits
+# for the background threads, a running search stops at its next step.
+def shutdown_separation(cache=voice_cache):
+    with cache.lock:
+        for key, future, cancel in cache.pending.values():
+            future.cancel()
+            cancel[0] = 1
+        cache.pending.clear()
+    background.shutdown(cancel_futures=True)
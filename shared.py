@@ -0,0 +1,139 @@
+"""
+    Shared-memory track snapshots
+    The notes of every staff are published as int64 columns in one
+    shared memory segment, with a JSON header for the rest of the track
+    and the tempo map. Worker processes attach without copying.
+    A small counter segment holds the version of the latest snapshot.
+"""
+from multiprocessing import shared_memory, resource_tracker
+import entities
+import resolution
+import numpy as np
+import json
+import os
+import struct
+import time
+
+SHARED_MAGIC = b'RNSHARE1'
+DEFAULT_TEMPO = 120
+
+def segment_name(name, version):
+    return f"{name}_{version}"
+
+# Attaching must not register the segment with the resource tracker,
+# or the segment would be unlinked when this process exits.
+def attach_segment(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+def align(offset):
+    return (offset + 7) & ~7
+
+# Owned by the process that edits the document.
+class SharedTrack:
+    def __init__(self, name=None):
+        self.name = name or f"rn{os.getpid()}"
+        self.counter = shared_memory.SharedMemory(f"{self.name}_v", create=True, size=8)
+        struct.pack_into('<q', self.counter.buf, 0, 0)
+        self.version = 0
+        self.segment = None
+
+    def publish(self, document):
+        track = document.track
+        staves = []
+        offset = 0
+        for graph in track.graphs:
+            if isinstance(graph, entities.Staff):
+                columns = entities.notes_as_columns(graph.notes)
+                staves.append((graph.uid, offset, len(graph.notes), columns))
+                offset += sum(len(column) * column.itemsize for column in columns)
+        version = self.version + 1
+        header = json.dumps({
+            'version': version,
+            'track': track.as_json(notes=False),
+            'tempo': resolution.tempo_envelope(track.graphs, DEFAULT_TEMPO).vector,
+            'staves': [(uid, offset, count) for uid, offset, count, columns in staves],
+        }).encode('utf-8')
+        base = align(16 + len(header))
+        segment = shared_memory.SharedMemory(segment_name(self.name, version), create=True, size=max(1, base + offset))
+        segment.buf[:8] = SHARED_MAGIC
+        struct.pack_into('<I', segment.buf, 8, len(header))
+        segment.buf[16:16 + len(header)] = header
+        for uid, offset, count, columns in staves:
+            at = base + offset
+            for column in columns:
+                data = memoryview(column).cast('B')
+                segment.buf[at:at + len(data)] = data
+                at += len(data)
+        # Workers that attached the previous snapshot keep their mapping after unlink.
+        struct.pack_into('<q', self.counter.buf, 0, version)
+        self.version = version
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+        self.segment = segment
+        return version
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+        self.counter.close()
+        self.counter.unlink()
+
+# Read-only view of the latest snapshot, for worker processes.
+class TrackView:
+    def __init__(self, name, retries=100):
+        self.counter = attach_segment(f"{name}_v")
+        for _ in range(retries):
+            version, = struct.unpack_from('<q', self.counter.buf, 0)
+            try:
+                self.segment = attach_segment(segment_name(name, version))
+                break
+            except FileNotFoundError:
+                # Replaced between reading the counter and attaching.
+                time.sleep(0.001)
+        else:
+            raise FileNotFoundError(f"no snapshot published as {name!r}")
+        buf = self.segment.buf
+        if bytes(buf[:8]) != SHARED_MAGIC:
+            raise ValueError("not a track snapshot")
+        length, = struct.unpack_from('<I', buf, 8)
+        header = json.loads(bytes(buf[16:16 + length]).decode('utf-8'))
+        base = align(16 + length)
+        self.version = header['version']
+        self.track = entities.Track.from_json(header['track'])
+        self.tempo = resolution.LinearEnvelope([tuple(v) for v in header['tempo']])
+        self.columns = {}
+        for uid, offset, count in header['staves']:
+            columns = {}
+            at = base + offset
+            for column, typecode in entities.NOTE_COLUMNS:
+                columns[column] = np.frombuffer(buf, dtype=np.int64, count=count, offset=at)
+                columns[column].flags.writeable = False
+                at += count * 8
+            self.columns[uid] = columns
+
+    def stale(self):
+        version, = struct.unpack_from('<q', self.counter.buf, 0)
+        return version != self.version
+
+    # Note2 objects for a staff, for code that wants them instead of the columns.
+    def notes(self, staff_uid):
+        columns = self.columns[staff_uid]
+        return entities.notes_from_columns([columns[column].tolist() for column, typecode in entities.NOTE_COLUMNS])
+
+    # Columns taken out of the view must have been dropped before closing.
+    def close(self):
+        self.columns = {}
+        self.segment.close()
+        self.counter.close()
@@ -1,12 +1,25 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <math.h>
+#include <string.h>
+#include <pthread.h>
+#include <time.h>
 
 // Define constants for the LCG (from Numerical Recipes)
 #define LCG_A 1664525
 #define LCG_C 1013904223
 #define LCG_M 4294967296  // 2^32
 
+// Outcome of the search of one slice.
+typedef struct {
+  int start;           // First note of the slice
+  int notes;
+  double cost;
+  double parts[5];     // Weighted pitch, gap, chord, overlap and cross penalties
+  long long iterations; // Search steps, summed over the restarts
+  int improvements;    // Times the search found a cheaper assignment
+} SliceStats;
+
 typedef struct {
   int max_notes;
   double *onset;
@@ -23,6 +36,14 @@ typedef struct {
   double cross_penalty;
   int pitch_lookback;
   unsigned int lcg;
+  int    *slice; // 1 where a slice starts, may be NULL
+  int restarts;  // Searches per slice, the cheapest is kept
+  int threads;   // Threads running the restarts
+  double time_budget;          // Seconds for the whole call, 0 for no limit
+  long long iteration_budget;  // Search iterations for the whole call, 0 for no limit
+  int exhausted; // Set when the budget ran out and later slices were only settled greedily
+  volatile int *cancel; // Solving stops soon after another thread sets this, may be NULL
+  SliceStats *stats; // Filled at the first note of each slice, may be NULL
 } Descriptor;
 
 int overlaps(Descriptor* m, int a, int b) {
@@ -43,22 +64,35 @@ int random_range(Descriptor* m, int min, int max) {
     return (lcg_random(m) % (max - min)) + min;
 }
 
+// Notes are sorted by onset, so a note overlaps every note of the slice
+// exactly when it starts before the earliest offset in the slice.
 int next_slice(Descriptor* m, int* start, int* stop) {
+    double min_offset;
     *start = *stop;
-    while (*stop < m->max_notes) {
-        int all_overlap = 1;
-        for (int i = *start; i < *stop; i++) {
-            all_overlap &= overlaps(m, i, *stop);
-        }
-        if (all_overlap) {
+    if (*stop < m->max_notes) {
+        min_offset = m->offset[*stop];
+        *stop += 1;
+        while (*stop < m->max_notes && m->onset[*stop] < min_offset) {
+            min_offset = fmin(min_offset, m->offset[*stop]);
             *stop += 1;
-        } else {
-            break;
         }
     }
     return *start < *stop;
 }
 
+// Writes where each slice starts, for notes sorted by onset. Returns the number of slices.
+int note_slices(int count, double* onset, double* offset, int* starts) {
+    Descriptor m = {0};
+    int start = 0, stop = 0, n = 0;
+    m.max_notes = count;
+    m.onset = onset;
+    m.offset = offset;
+    while (next_slice(&m, &start, &stop)) {
+        starts[n++] = start;
+    }
+    return n;
+}
+
 int previous_chord(Descriptor* m, int i) {
     double onset = m->onset[i];
     while (m->link[i] >= 0) {
@@ -146,92 +180,112 @@ double chord_position(Descriptor* m, int i, double ref) {
     return m->position[b];
 }
 
-double calculate_pitch_penalty(Descriptor* m, int start, int stop, int* links) {
-    double pD = 0.0, pvD, p;
-    int i, j, k;
-    for (int v = 0; v < m->max_voices; v++) {
-        i = links[v];
-        pvD = 0.0;
-        while (start <= i) {
-            if ((j = previous_chord(m, i)) >= 0) {
-                p = chord_position(m, j, m->position[i]);
-                k = 0;
-                while (k < m->pitch_lookback && (j = previous_chord(m, j)) >= 0) {
-                    k += 1;
-                    p = 0.8*p + 0.2*chord_position(m, j, m->position[i]);
-                }
-                pvD += (1.0 - pvD) * fmin(1.0, fabs(m->position[i] - p) / 128.0);
+// Penalties of one voice in the slice, i is the last note of the voice.
+// The search keeps these per voice and combines them into the total cost,
+// so moving a note only recomputes the two voices it moves between.
+double voice_pitch_penalty(Descriptor* m, int start, int i) {
+    double pvD = 0.0, p;
+    int j, k;
+    while (start <= i) {
+        if ((j = previous_chord(m, i)) >= 0) {
+            p = chord_position(m, j, m->position[i]);
+            k = 0;
+            while (k < m->pitch_lookback && (j = previous_chord(m, j)) >= 0) {
+                k += 1;
+                p = 0.8*p + 0.2*chord_position(m, j, m->position[i]);
             }
-            i = m->link[i];
+            pvD += (1.0 - pvD) * fmin(1.0, fabs(m->position[i] - p) / 128.0);
         }
-        pD += (1.0 - pD) * pvD;
+        i = m->link[i];
     }
-    return pD;
+    return pvD;
 }
 
-double calculate_gap_penalty(Descriptor* m, int start, int stop, int* links) {
+double voice_gap_penalty(Descriptor* m, int start, int i, int* cNotes) {
     double gD = 0.0, offset;
-    int cNotes = 0;
-    int i, j;
-    for (int v = 0; v < m->max_voices; v++) {
-        i = links[v];
-        while (start <= i) {
-            if ((j = previous_chord(m, i)) >= 0) {
-                offset = m->offset[max_offset(m, j)];
-            } else {
-                offset = 0.0;
-            }
-            gD += fmax(0.0, fmin(1.0, (m->onset[i] - offset) / 4.0));
-            cNotes += 1;
-            i = previous_chord(m, i);
+    int j;
+    while (start <= i) {
+        if ((j = previous_chord(m, i)) >= 0) {
+            offset = m->offset[max_offset(m, j)];
+        } else {
+            offset = 0.0;
         }
+        gD += fmax(0.0, fmin(1.0, (m->onset[i] - offset) / 4.0));
+        *cNotes += 1;
+        i = previous_chord(m, i);
     }
-    if (cNotes == 0) {
-        return 0.0;
-    } else {
-        return gD / cNotes;
-    }
+    return gD;
 }
 
-double calculate_chord_penalty(Descriptor* m, int start, int stop, int* links) {
+double voice_chord_penalty(Descriptor* m, int start, int i) {
     double cD = 0.0, minDuration, maxDuration, minPosition, maxPosition;
     double pDuration, pRange;
-    int i;
-    for (int v = 0; v < m->max_voices; v++) {
-        i = links[v];
-        while (start <= i) {
-            minDuration = m->duration[min_duration(m, i)];
-            maxDuration = m->duration[max_duration(m, i)];
-            minPosition = m->position[min_position(m, i)];
-            maxPosition = m->position[max_position(m, i)];
-            pDuration = 1.0 - minDuration / maxDuration;
-            pRange = fmin(1.0, (maxPosition - minPosition) / 24);
-            cD = cD + (1.0 - cD) * (pDuration + (1.0 - pDuration) * pRange);
-            i = previous_chord(m, i);
-        }
+    while (start <= i) {
+        minDuration = m->duration[min_duration(m, i)];
+        maxDuration = m->duration[max_duration(m, i)];
+        minPosition = m->position[min_position(m, i)];
+        maxPosition = m->position[max_position(m, i)];
+        pDuration = 1.0 - minDuration / maxDuration;
+        pRange = fmin(1.0, (maxPosition - minPosition) / 24);
+        cD = cD + (1.0 - cD) * (pDuration + (1.0 - pDuration) * pRange);
+        i = previous_chord(m, i);
     }
     return cD;
 }
 
-double calculate_overlap_penalty(Descriptor* m, int start, int stop, int* links) {
-    double oD = 0.0, ovD, oDist;
-    int i, j;
-    for (int v = 0; v < m->max_voices; v++) {
-        ovD = 0.0;
-        i = links[v];
-        while (start <= i) {
-            if ((j = previous_chord(m, i)) >= 0) {
-                 j = max_duration(m, j);
-                 if (overlaps(m, j, i)) {
-                     oDist = 1.0 - (m->onset[i] - m->onset[j]) / m->duration[j];
-                     ovD = ovD + (1.0 - ovD) * oDist;
-                 }
-            }
-            i = previous_chord(m, i);
+double voice_overlap_penalty(Descriptor* m, int start, int i) {
+    double ovD = 0.0, oDist;
+    int j;
+    while (start <= i) {
+        if ((j = previous_chord(m, i)) >= 0) {
+             j = max_duration(m, j);
+             if (overlaps(m, j, i)) {
+                 oDist = 1.0 - (m->onset[i] - m->onset[j]) / m->duration[j];
+                 ovD = ovD + (1.0 - ovD) * oDist;
+             }
         }
-        oD = oD + (1.0 - oD) * ovD;
+        i = previous_chord(m, i);
+    }
+    return ovD;
+}
+
+typedef struct {
+    double pitch;
+    double gap;
+    int    chords;     // Chords counted by the gap penalty
+    double chord;
+    double overlap;
+    double position0;  // Average positions of the first chord in the slice
+    double position1;  // and the chord before it, for the cross penalty
+    int    present;
+} VoiceCost;
+
+void voice_positions(Descriptor* m, int start, int i, VoiceCost* c) {
+    int count = 0;
+    c->position0 = 0.0;
+    c->position1 = 0.0;
+    c->present = 0;
+    if (i < 0) return;
+    do {
+        c->position0 = average_position(m, i, &count);
+        i = previous_chord(m, i);
+    } while (start <= i);
+    if (i >= 0) {
+        c->position0 /= count;
+        count = 0;
+        c->position1 = average_position(m, i, &count);
+        c->position1 /= count;
+        c->present = 1;
     }
-    return oD;
+}
+
+void voice_cost(Descriptor* m, int start, int i, VoiceCost* c) {
+    c->pitch = voice_pitch_penalty(m, start, i);
+    c->chords = 0;
+    c->gap = voice_gap_penalty(m, start, i, &c->chords);
+    c->chord = voice_chord_penalty(m, start, i);
+    c->overlap = voice_overlap_penalty(m, start, i);
+    voice_positions(m, start, i, c);
 }
 
 void swap(int* a, int* b) {
@@ -273,8 +327,7 @@ void quicksort(int voice[], int present[], double position0[], double position1[
     }
 }
 
-double calculate_cross_penalty(Descriptor* m, int start, int stop, int* links) {
-    int i, count;
+double calculate_cross_penalty(Descriptor* m, VoiceCost* costs) {
     int voice[m->max_voices];
     int present[m->max_voices];
     double position0[m->max_voices];
@@ -283,27 +336,9 @@ double calculate_cross_penalty(Descriptor* m, int start, int stop, int* links) {
     int k;
     for (int v = 0; v < m->max_voices; v++) {
         voice[v] = v;
-        position0[v] = 0.0;
-        position1[v] = 0.0;
-        count = 0;
-        i = links[v];
-        if (i < 0) {
-            present[v] = 0;
-            continue;
-        }
-        do {
-            position0[v] = average_position(m, i, &count);
-            i = previous_chord(m, i);
-        } while (start <= i);
-        if (i >= 0) {
-            position0[v] /= count;
-            count = 0;
-            position1[v] = average_position(m, i, &count);
-            position1[v] /= count;
-            present[v] = 1;
-        } else {
-            present[v] = 0;
-        }
+        present[v] = costs[v].present;
+        position0[v] = costs[v].position0;
+        position1[v] = costs[v].position1;
     }
     quicksort(voice, present, position0, position1, 0, m->max_voices-1);
     p = 0.0;
@@ -318,112 +353,504 @@ double calculate_cross_penalty(Descriptor* m, int start, int stop, int* links) {
     return 0.0;
 }
 
-double calculate_total_cost(Descriptor* m, int start, int stop, int* links, int print) {
-    int sublinks[m->max_voices];
-    for (int i = 0; i < m->max_voices; i++) {
-        sublinks[i] = links[i];
+// Weighted sum of the penalties, parts receives them one by one if not NULL.
+double combined_cost(Descriptor* m, VoiceCost* costs, double* parts) {
+    double pD = 0.0, gD = 0.0, cD = 0.0, oD = 0.0;
+    int cNotes = 0;
+    for (int v = 0; v < m->max_voices; v++) {
+        pD += (1.0 - pD) * costs[v].pitch;
+        gD += costs[v].gap;
+        cNotes += costs[v].chords;
+        cD += (1.0 - cD) * costs[v].chord;
+        oD += (1.0 - oD) * costs[v].overlap;
     }
+    double pp = m->pitch_penalty * pD;
+    double gp = m->gap_penalty * (cNotes == 0 ? 0.0 : gD / cNotes);
+    double cp = m->chord_penalty * cD;
+    double op = m->overlap_penalty * oD;
+    double rp = m->cross_penalty * calculate_cross_penalty(m, costs);
+    if (parts) {
+        parts[0] = pp;
+        parts[1] = gp;
+        parts[2] = cp;
+        parts[3] = op;
+        parts[4] = rp;
+    }
+    return pp + gp + cp + op + rp;
+}
+
+// Chains the slice notes of voice v behind links[v], returns the last one.
+int relink(Descriptor* m, int start, int stop, int* links, int v) {
+    int head = links[v];
     for (int i = start; i < stop; i++) {
-        m->link[i] = sublinks[m->voice[i]];
-        sublinks[m->voice[i]] = i;
-    }
-    double total_cost = 0.0, pp, gp, cp, op, rp;
-    total_cost += pp = m->pitch_penalty * calculate_pitch_penalty(m, start, stop, sublinks);
-    total_cost += gp = m->gap_penalty * calculate_gap_penalty(m, start, stop, sublinks);
-    total_cost += cp = m->chord_penalty * calculate_chord_penalty(m, start, stop, sublinks);
-    total_cost += op = m->overlap_penalty * calculate_overlap_penalty(m, start, stop, sublinks);
-    total_cost += rp = m->cross_penalty * calculate_cross_penalty(m, start, stop, sublinks);
-    if (print) {
-        for (int k = 0; k < m->max_voices; k++) {
-            printf("voice %d\n", k);
-            for (int i = start; i < stop; i++) {
-                if (m->voice[i] == k) printf("  note: %f:%f p=%d\n", m->onset[i], m->offset[i], m->position[i]);
-            }
+        if (m->voice[i] == v) {
+            m->link[i] = head;
+            head = i;
         }
-        printf("total pen: %f\n", total_cost);
-        printf("  pitch pen: %f\n", pp);
-        printf("  gap pen: %f\n", gp);
-        printf("  chord pen: %f\n", cp);
-        printf("  overlap pen: %f\n", op);
-        printf("  cross pen: %f\n", rp);
     }
-    return total_cost;
+    return head;
 }
 
-void lowest_cost_neighbor(Descriptor* m, int start, int stop, int* links) {
+// Cost of the voices of a slice, parts receives the weighted penalties.
+double calculate_total_cost(Descriptor* m, int start, int stop, int* links, double* parts) {
+    VoiceCost costs[m->max_voices];
+    for (int v = 0; v < m->max_voices; v++) {
+        voice_cost(m, start, relink(m, start, stop, links, v), &costs[v]);
+    }
+    return combined_cost(m, costs, parts);
+}
+
+// Moves note i to voice v, the chains and costs of both voices follow.
+void move_note(Descriptor* m, int start, int stop, int* links, VoiceCost* costs, int i, int v) {
+    int u = m->voice[i];
+    m->voice[i] = v;
+    voice_cost(m, start, relink(m, start, stop, links, u), &costs[u]);
+    voice_cost(m, start, relink(m, start, stop, links, v), &costs[v]);
+}
+
+// Tries every single note move. Only the voice a note leaves and
+// the voice it joins are re-evaluated, the rest come from costs.
+int lowest_cost_neighbor(Descriptor* m, int start, int stop, int* links, VoiceCost* costs) {
     int voice_index;
     int best_index = start;
     int best_voice = m->voice[start];
     double best_cost, new_cost;
-    best_cost = calculate_total_cost(m, start, stop, links, 0);
+    VoiceCost trial[m->max_voices];
+    memcpy(trial, costs, sizeof trial);
+    best_cost = combined_cost(m, costs, NULL);
     for (int i = start; i < stop; i++) {
         voice_index = m->voice[i];
+        m->voice[i] = -1;
+        voice_cost(m, start, relink(m, start, stop, links, voice_index), &trial[voice_index]);
         for (int j = 0; j < m->max_voices; j++) {
             if (j != voice_index) {
                 m->voice[i] = j;
-                new_cost = calculate_total_cost(m, start, stop, links, 0);
+                voice_cost(m, start, relink(m, start, stop, links, j), &trial[j]);
+                new_cost = combined_cost(m, trial, NULL);
                 if (new_cost < best_cost) {
                     best_index = i;
                     best_voice = j;
                     best_cost = new_cost;
                 }
+                trial[j] = costs[j];
             }
         }
         m->voice[i] = voice_index;
+        trial[voice_index] = costs[voice_index];
     }
-    m->voice[best_index] = best_voice;
+    // Trials leave chains stale, every voice is relinked before it is evaluated again.
+    if (best_voice == m->voice[best_index]) return 0;
+    move_note(m, start, stop, links, costs, best_index, best_voice);
+    return 1;
 }
 
-void random_neighbour(Descriptor* m, int start, int stop) {
+void random_neighbour(Descriptor* m, int start, int stop, int* links, VoiceCost* costs) {
     int index, voice_index;
     index = random_range(m, start, stop);
     voice_index = random_range(m, 0, m->max_voices-1);
     if (voice_index >= m->voice[index]) voice_index++;
-    m->voice[index] = voice_index;
+    move_note(m, start, stop, links, costs, index, voice_index);
+}
+
+typedef struct {
+    double deadline;      // Monotonic seconds, 0 for none
+    long long iterations; // Left to spend, -1 for no limit
+    int exhausted;
+    volatile int* cancel;
+} Budget;
+
+int cancelled(Budget* b) {
+    return b->cancel && *b->cancel;
 }
 
-void stochastic_local_search(Descriptor* m, int start, int stop, int* links) {
+double monotonic_time() {
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + t.tv_nsec * 1e-9;
+}
+
+int spend(Budget* b) {
+    if (b->exhausted || b->iterations == 0 || cancelled(b)
+        || (b->deadline > 0 && monotonic_time() >= b->deadline)) {
+        b->exhausted = 1;
+        return 0;
+    }
+    if (b->iterations > 0) b->iterations--;
+    return 1;
+}
+
+// Returns the best assignment found once the budget runs out.
+// With the budget already spent the slice is only settled greedily,
+// which stays cheap but lets every later slice still get voices.
+// stats may be NULL, the greedy sweeps count as steps there too.
+double stochastic_local_search(Descriptor* m, int start, int stop, int* links, Budget* budget, SliceStats* stats) {
+    long long iterations = 0;
+    int improvements = 0;
     int no_improvement_counter;
     int max_iterations;
+    int settled = 0; // No move improves on the current voices
     int best[stop - start];
     double best_cost, new_cost;
+    VoiceCost costs[m->max_voices];
     max_iterations = (stop - start) * m->max_voices * 3;
     for (int i = 0; i < stop - start; i++) {
         best[i] = m->voice[i+start] = 0;
     }
-    best_cost = calculate_total_cost(m, start, stop, links, 0);
+    for (int v = 0; v < m->max_voices; v++) {
+        voice_cost(m, start, relink(m, start, stop, links, v), &costs[v]);
+    }
+    best_cost = combined_cost(m, costs, NULL);
     no_improvement_counter = 0;
+    if (budget && budget->exhausted) {
+        while (lowest_cost_neighbor(m, start, stop, links, costs)) {
+            iterations++;
+            improvements++;
+        }
+        for (int i = 0; i < stop - start; i++) {
+            best[i] = m->voice[i+start];
+        }
+        best_cost = combined_cost(m, costs, NULL);
+        max_iterations = 0;
+    }
     while (no_improvement_counter < max_iterations) {
+        if (budget && !spend(budget)) break;
+        iterations++;
         if (random_double(m) <= 0.8) {
-            lowest_cost_neighbor(m, start, stop, links);
+            // A sweep from a settled state would find no move again.
+            if (!settled) settled = !lowest_cost_neighbor(m, start, stop, links, costs);
         } else {
-            random_neighbour(m, start, stop);
+            random_neighbour(m, start, stop, links, costs);
+            settled = 0;
         }
-        new_cost = calculate_total_cost(m, start, stop, links, 0);
+        new_cost = combined_cost(m, costs, NULL);
         if (new_cost < best_cost) {
             for (int i = 0; i < stop - start; i++) {
                 best[i] = m->voice[i+start];
             }
             best_cost = new_cost;
             no_improvement_counter = 0;
+            improvements++;
         } else {
             no_improvement_counter += 1;
         }
     }
     for (int i = 0; i < stop - start; i++) {
         m->voice[i+start] = best[i];
+    }
+    if (stats) {
+        stats->start = start;
+        stats->notes = stop - start;
+        stats->cost = calculate_total_cost(m, start, stop, links, stats->parts);
+        stats->iterations = iterations;
+        stats->improvements = improvements;
+    }
+    for (int i = 0; i < stop - start; i++) {
         m->link[i+start] = links[best[i]];
         links[best[i]] = i+start;
     }
+    return best_cost;
+}
+
+// Each slice is searched from its own seed, so re-solving a slice
+// gives the same result whatever was solved before it.
+unsigned int slice_seed(unsigned int seed, double onset) {
+    unsigned long long x;
+    memcpy(&x, &onset, sizeof x);
+    x ^= seed + 0x9e3779b97f4a7c15ULL;
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    return (unsigned int)(x ^ (x >> 31));
+}
+
+// Restart 0 uses the base seed, so a single restart gives the plain search.
+unsigned int restart_seed(unsigned int seed, int restart) {
+    return restart == 0 ? seed : seed ^ (0x9e3779b9u * (unsigned int)restart);
+}
+
+// Each restart searches on its own copy of voice and link, all copies
+// agree on the slices solved so far. The cheapest restart wins a slice,
+// the lowest numbered on ties, so the result does not depend on threads.
+typedef struct {
+    Descriptor d;
+    int *heads;
+    double cost;
+    Budget budget;
+    SliceStats stats;
+} Restart;
+
+typedef struct Solver Solver;
+
+typedef struct {
+    Solver* solver;
+    int id;
+} Worker;
+
+struct Solver {
+    Descriptor* m;
+    unsigned int seed;
+    int restarts;
+    int threads;
+    Restart* restart;
+    int start, stop;
+    int* links;
+    Budget budget;
+    int done;
+    pthread_t* workers; // NULL when the restarts run on the calling thread
+    Worker* worker;
+    pthread_barrier_t ready;
+    pthread_barrier_t finished;
+};
+
+// Slices with fewer notes run every restart on the calling thread,
+// waking the workers costs more than such a search.
+#define PARALLEL_SLICE 16
+
+void run_restarts(Solver* s, int id, int step) {
+    for (int r = id; r < s->restarts; r += step) {
+        Restart* x = &s->restart[r];
+        memcpy(x->heads, s->links, s->m->max_voices * sizeof(int));
+        x->d.lcg = slice_seed(restart_seed(s->seed, r), s->m->onset[s->start]);
+        x->budget = s->budget;
+        x->cost = stochastic_local_search(&x->d, s->start, s->stop, x->heads, &x->budget, s->m->stats ? &x->stats : NULL);
+    }
+}
+
+void* restart_worker(void* arg) {
+    Worker* w = arg;
+    Solver* s = w->solver;
+    for (;;) {
+        pthread_barrier_wait(&s->ready);
+        if (s->done) break;
+        run_restarts(s, w->id, s->threads);
+        pthread_barrier_wait(&s->finished);
+    }
+    return NULL;
+}
+
+void solver_init(Solver* s, Descriptor* m) {
+    s->m = m;
+    s->seed = m->lcg;
+    s->restarts = m->restarts < 1 ? 1 : m->restarts;
+    s->threads = m->threads < 1 ? 1 : m->threads;
+    if (s->threads > s->restarts) s->threads = s->restarts;
+    s->budget.deadline = m->time_budget > 0 ? monotonic_time() + m->time_budget : 0;
+    s->budget.iterations = m->iteration_budget > 0 ? m->iteration_budget : -1;
+    s->budget.exhausted = 0;
+    s->budget.cancel = m->cancel;
+    s->done = 0;
+    s->restart = calloc(s->restarts, sizeof(Restart));
+    for (int r = 0; r < s->restarts; r++) {
+        Restart* x = &s->restart[r];
+        x->d = *m;
+        x->d.slice = NULL;
+        x->d.stats = NULL;
+        x->heads = malloc(m->max_voices * sizeof(int));
+        if (r > 0) {
+            x->d.voice = malloc(m->max_notes * sizeof(int));
+            x->d.link = malloc(m->max_notes * sizeof(int));
+            memcpy(x->d.voice, m->voice, m->max_notes * sizeof(int));
+            memcpy(x->d.link, m->link, m->max_notes * sizeof(int));
+        }
+    }
+    s->workers = NULL;
+    if (s->threads > 1) {
+        s->worker = malloc(s->threads * sizeof(Worker));
+        pthread_barrier_init(&s->ready, NULL, s->threads);
+        pthread_barrier_init(&s->finished, NULL, s->threads);
+        s->workers = malloc(s->threads * sizeof(pthread_t));
+        for (int t = 1; t < s->threads; t++) {
+            s->worker[t].solver = s;
+            s->worker[t].id = t;
+            pthread_create(&s->workers[t], NULL, restart_worker, &s->worker[t]);
+        }
+    }
+}
+
+void solver_free(Solver* s) {
+    if (s->workers) {
+        s->done = 1;
+        pthread_barrier_wait(&s->ready);
+        for (int t = 1; t < s->threads; t++) {
+            pthread_join(s->workers[t], NULL);
+        }
+        pthread_barrier_destroy(&s->ready);
+        pthread_barrier_destroy(&s->finished);
+        free(s->worker);
+        free(s->workers);
+    }
+    for (int r = 0; r < s->restarts; r++) {
+        free(s->restart[r].heads);
+        if (r > 0) {
+            free(s->restart[r].d.voice);
+            free(s->restart[r].d.link);
+        }
+    }
+    free(s->restart);
+    s->m->lcg = s->seed;
+    s->m->exhausted = s->budget.exhausted;
+}
+
+void solve_slice(Solver* s, int start, int stop, int* links) {
+    Descriptor* m = s->m;
+    int w = 0;
+    if (m->slice) {
+        for (int i = start; i < stop; i++) m->slice[i] = (i == start);
+    }
+    s->start = start;
+    s->stop = stop;
+    s->links = links;
+    if (stop - start == 1 || s->restarts == 1) {
+        // A lone note is placed optimally by the first sweep.
+        s->restart[0].d.lcg = slice_seed(s->seed, m->onset[start]);
+        memcpy(s->restart[0].heads, links, m->max_voices * sizeof(int));
+        stochastic_local_search(&s->restart[0].d, start, stop, s->restart[0].heads, &s->budget, m->stats ? &s->restart[0].stats : NULL);
+    } else if (!s->workers || stop - start < PARALLEL_SLICE) {
+        run_restarts(s, 0, 1);
+    } else {
+        pthread_barrier_wait(&s->ready);
+        run_restarts(s, 0, s->threads);
+        pthread_barrier_wait(&s->finished);
+    }
+    if (!(stop - start == 1 || s->restarts == 1)) {
+        // Every restart had the whole remaining budget, the hungriest one sets what is left.
+        for (int r = 0; r < s->restarts; r++) {
+            Budget* b = &s->restart[r].budget;
+            if (s->restart[r].cost < s->restart[w].cost) w = r;
+            if (s->budget.iterations > b->iterations) s->budget.iterations = b->iterations;
+            s->budget.exhausted |= b->exhausted;
+        }
+    }
+    memcpy(links, s->restart[w].heads, m->max_voices * sizeof(int));
+    if (m->stats) {
+        m->stats[start] = s->restart[w].stats;
+        if (!(stop - start == 1 || s->restarts == 1)) {
+            for (int r = 0; r < s->restarts; r++) {
+                if (r != w) m->stats[start].iterations += s->restart[r].stats.iterations;
+            }
+        }
+    }
+    for (int r = 0; r < s->restarts; r++) {
+        if (r == w) continue;
+        memcpy(s->restart[r].d.voice + start, s->restart[w].d.voice + start, (stop - start) * sizeof(int));
+        memcpy(s->restart[r].d.link + start, s->restart[w].d.link + start, (stop - start) * sizeof(int));
+    }
 }
 
 void voice_separation(Descriptor* m) {
+    Solver solver;
     int start = 0, stop = 0;
     int links[m->max_voices];
     for (int i = 0; i < m->max_voices; i++) {
         links[i] = -1;
     }
+    solver_init(&solver, m);
+    while (!cancelled(&solver.budget) && next_slice(m, &start, &stop)) {
+        solve_slice(&solver, start, stop, links);
+    }
+    solver_free(&solver);
+}
+
+// Cost of the voices already assigned, summed over the slices.
+// parts receives the weighted pitch, gap, chord, overlap and cross penalties.
+double voice_separation_cost(Descriptor* m, double* parts) {
+    int start = 0, stop = 0;
+    int links[m->max_voices];
+    VoiceCost costs[m->max_voices];
+    double slice_parts[5], total = 0.0;
+    for (int v = 0; v < m->max_voices; v++) {
+        links[v] = -1;
+    }
+    for (int k = 0; k < 5; k++) {
+        parts[k] = 0.0;
+    }
     while (next_slice(m, &start, &stop)) {
-        stochastic_local_search(m, start, stop, links);
+        for (int v = 0; v < m->max_voices; v++) {
+            voice_cost(m, start, relink(m, start, stop, links, v), &costs[v]);
+        }
+        total += combined_cost(m, costs, slice_parts);
+        for (int k = 0; k < 5; k++) {
+            parts[k] += slice_parts[k];
+        }
+        for (int v = 0; v < m->max_voices; v++) {
+            links[v] = relink(m, start, stop, links, v);
+        }
+    }
+    return total;
+}
+
+int same_note(Descriptor* m, int i, Descriptor* c, int k) {
+    return m->onset[i] == c->onset[k]
+        && m->duration[i] == c->duration[k]
+        && m->position[i] == c->position[k];
+}
+
+// The costs of later slices look back pitch_lookback+1 chords in each voice.
+// If those match, the later slices are solved the same way.
+int same_history(Descriptor* m, int i, Descriptor* c, int k) {
+    int chords = 0, j, l, ends;
+    while (i >= 0 && k >= 0) {
+        if (!same_note(m, i, c, k)) return 0;
+        j = m->link[i];
+        l = c->link[k];
+        ends = j < 0 || m->onset[j] < m->onset[i];
+        if (ends != (l < 0 || c->onset[l] < c->onset[k])) return 0;
+        if (ends && ++chords > m->pitch_lookback) return 1;
+        i = j;
+        k = l;
+    }
+    return i < 0 && k < 0;
+}
+
+// Re-solves the notes from resume onwards, an earlier result c with
+// slice flags tells where it can stop. voice, link and slice must hold
+// the earlier result below resume, where the notes are unchanged.
+// Once a slice boundary is reached where the remaining notes and the voice
+// histories match c, the rest of c is copied over.
+// Returns the index where solving stopped.
+int voice_separation_resume(Descriptor* m, Descriptor* c, int resume) {
+    Solver solver;
+    int start = resume, stop = resume;
+    int delta = c->max_notes - m->max_notes;
+    int same = 0, at = resume, k, v, converged;
+    int links[m->max_voices];
+    int cached_links[m->max_voices];
+    for (v = 0; v < m->max_voices; v++) {
+        links[v] = -1;
+    }
+    for (int i = 0; i < resume; i++) {
+        links[m->voice[i]] = i;
+    }
+    memcpy(cached_links, links, sizeof links);
+    solver_init(&solver, m);
+    while (same < m->max_notes && same < c->max_notes
+           && same_note(m, m->max_notes - 1 - same, c, c->max_notes - 1 - same)) {
+        same++;
+    }
+    while (!cancelled(&solver.budget) && next_slice(m, &start, &stop)) {
+        solve_slice(&solver, start, stop, links);
+        k = stop + delta;
+        if (m->max_notes - stop > same || k < at || k >= c->max_notes || !c->slice[k]) continue;
+        for (; at < k; at++) {
+            cached_links[c->voice[at]] = at;
+        }
+        converged = 1;
+        for (v = 0; v < m->max_voices && converged; v++) {
+            converged = same_history(m, links[v], c, cached_links[v]);
+        }
+        if (converged) {
+            memcpy(m->voice + stop, c->voice + k, (m->max_notes - stop) * sizeof(int));
+            memcpy(m->slice + stop, c->slice + k, (m->max_notes - stop) * sizeof(int));
+            if (m->stats && c->stats) {
+                memcpy(m->stats + stop, c->stats + k, (m->max_notes - stop) * sizeof(SliceStats));
+                for (int i = stop; i < m->max_notes; i++) m->stats[i].start = i;
+            }
+            for (int i = stop; i < m->max_notes; i++) {
+                m->link[i] = links[m->voice[i]];
+                links[m->voice[i]] = i;
+            }
+            break;
+        }
     }
+    solver_free(&solver);
+    return stop;
 }